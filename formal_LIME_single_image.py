@@ -16,6 +16,7 @@ from lime import lime_image
 from lime.wrappers.scikit_image import SegmentationAlgorithm
 
 use_cuda = torch.cuda.is_available()
+device = 'cuda' if use_cuda else 'cpu'
 # Fixing for deterministic results
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
@@ -67,6 +68,30 @@ def get_arguments():
                         default='/home/chirag/gpu3_codes/generative_inpainting_FIDO/model_logs/release_imagenet_256/',
                         help='path for the weight files of the inpainter model for imagenet | places365')
 
+    parser.add_argument('--backend', type=str,
+                        default='fp32', help='classifier backend: fp32 | int8 (statically quantized, runs on the CPU) | '
+                                             'jit (traced, frozen, channels-last)')
+
+    parser.add_argument('--compiled_dir', type=str,
+                        default='./compiled_models', help='cache directory of the --backend jit classifiers')
+
+    parser.add_argument('--calib_images', type=str,
+                        default=CALIBRATION_IMAGES,
+                        help='comma separated calibration images or glob patterns for --backend int8')
+
+    parser.add_argument('--save_intermediate', type=str,
+                        default='reservoir:20', help='intermediate images to save: every:k | reservoir:N | off')
+
+    parser.add_argument('--inpaint_cache_dir', type=str,
+                        default='', help='directory of the persistent inpainting cache, empty = no cache')
+
+    parser.add_argument('--inpaint_cache_mb', type=int,
+                        default=2048, help='size cap of the inpainting cache directory in MB')
+    parser.add_argument('--inpainter', default='tf', type=str,
+                        help='CA-inpainter implementation: tf | torch (pytorch port loading the same checkpoint)')
+    parser.add_argument('--inpaint_frozen', type=int,
+                        default=0, help='tensorflow inpainter: run frozen inference graphs cached next to --weight_file')
+
     parser.add_argument('--dataset', type=str,
                         default='imagenet', help='dataset to run on imagenet | places365')
 
@@ -79,9 +104,15 @@ def get_arguments():
     return args
 
 
-def load_orig_imagenet_model(arch_name='resnet50', if_pre=0):
+def load_orig_imagenet_model(arch_name='resnet50', if_pre=0, backend='fp32', calibration_images=None,
+                             compiled_dir='./compiled_models'):
 
     model = models.resnet50(pretrained=True)
+    if backend == 'int8':
+        model = CPUClassifier(quantize_model(model, arch_name, calibration_images))
+    elif backend == 'jit':
+        model = compile_model(model, '{}_imagenet'.format(arch_name), (3, 224, 224), cache_dir=compiled_dir,
+                              device=device)
     if if_pre == 1:
         pass
     else:
@@ -90,12 +121,13 @@ def load_orig_imagenet_model(arch_name='resnet50', if_pre=0):
     for p in model.parameters():
         p.requires_grad = False
 
-    model = model.to('cuda')
+    model = model.to(device)
     model.eval()
     return model
 
 
-def load_orig_places365_model(arch_name='resnet50', if_pre=0):  #
+def load_orig_places365_model(arch_name='resnet50', if_pre=0, backend='fp32', calibration_images=None,
+                              compiled_dir='./compiled_models'):  #
 
     # load the pre-trained weights
     model_file = '%s_places365.pth.tar' % arch_name
@@ -107,6 +139,11 @@ def load_orig_places365_model(arch_name='resnet50', if_pre=0):  #
     checkpoint = torch.load(model_file, map_location=lambda storage, loc: storage)
     state_dict = {str.replace(k, 'module.', ''): v for k, v in checkpoint['state_dict'].items()}
     model.load_state_dict(state_dict)
+    if backend == 'int8':
+        model = CPUClassifier(quantize_model(model, arch_name, calibration_images))
+    elif backend == 'jit':
+        model = compile_model(model, '{}_places365'.format(arch_name), (3, 224, 224), cache_dir=compiled_dir,
+                              device=device)
 
     if if_pre == 1:
         pass
@@ -116,7 +153,7 @@ def load_orig_places365_model(arch_name='resnet50', if_pre=0):  #
     for p in model.parameters():
         p.requires_grad = False
 
-    model = model.to('cuda')
+    model = model.to(device)
     model.eval()
     return model
 
@@ -151,14 +188,21 @@ if __name__ == '__main__':
     f_time = ''.join(str(s_time).split('.'))
     args = get_arguments()
 
+    calibration_images = load_calibration_images(calibration_paths(args.calib_images)) \
+        if args.backend == 'int8' else None
+
     if args.dataset == 'imagenet':
-        pytorch_model = load_orig_imagenet_model(arch_name='resnet50')
+        pytorch_model = load_orig_imagenet_model(arch_name='resnet50', backend=args.backend,
+                                                 calibration_images=calibration_images,
+                                                 compiled_dir=args.compiled_dir)
 
         # load the class label
         label_map = load_imagenet_label_map()
 
     elif args.dataset == 'places365':
-        pytorch_model = load_orig_places365_model(arch_name='resnet50')
+        pytorch_model = load_orig_places365_model(arch_name='resnet50', backend=args.backend,
+                                                  calibration_images=calibration_images,
+                                                  compiled_dir=args.compiled_dir)
 
         # load the class label
         label_map = load_class_label()
@@ -179,7 +223,7 @@ if __name__ == '__main__':
 
     def pytorch_batch_predict(images):
         batch = torch.stack(tuple(pytorch_preprocess_transform(i) for i in images), dim=0)
-        batch = batch.to('cuda')
+        batch = batch.to(device)
 
         if args.if_pre == 1:
             logits = pytorch_model(batch)
@@ -193,10 +237,18 @@ if __name__ == '__main__':
 
         # Generative ImageNet Contextual Attention (TENSORFLOW)
         sys.path.insert(0, './generative_inpainting/')
-        from CAInpainter import CAInpainter
+        if args.inpainter == 'torch':
+            from CAInpainter2 import CAInpainter2 as CAInpainter
+            inpainter_options = {}
+        else:
+            from CAInpainter import CAInpainter
+            inpainter_options = {'frozen': args.inpaint_frozen}
+        from inpaint_cache import InpaintCache
 
+        inpaint_cache = InpaintCache(args.inpaint_cache_dir, max_disk_mb=args.inpaint_cache_mb) \
+            if args.inpaint_cache_dir else None
         inpaint_model = CAInpainter(args.batch_size,
-                                    checkpoint_dir=args.weight_file)
+                                    checkpoint_dir=args.weight_file, cache=inpaint_cache, **inpainter_options)
         inpaint_model.eval()
     else:
         inpaint_model = pytorch_model
@@ -214,7 +266,7 @@ if __name__ == '__main__':
     # This image will be passed to Lime Explainer
     img = get_image(args.img_path)
 
-    pytorch_img = pytorch_preprocessFn(Image.open(args.img_path).convert('RGB')).to('cuda').unsqueeze(0)
+    pytorch_img = pytorch_preprocessFn(Image.open(args.img_path).convert('RGB')).to(device).unsqueeze(0)
     outputs = pytorch_model(pytorch_img)
 
     if args.dataset == 'imagenet':
@@ -231,9 +283,9 @@ if __name__ == '__main__':
     # save_dir
     save_path = os.path.join(args.save_path, '{}'.format(args.algo), '{}'.format(args.dataset))
     mkdir_p(save_path)
-    # save path for intermediate steps
-    save_intermediate = os.path.join(save_path, 'intermediate_steps')
-    mkdir_p(save_intermediate)
+    # Intermediate steps are saved from a background thread
+    writer = IntermediateWriter(os.path.join(save_path, 'intermediate_steps'), label_map,
+                                policy=args.save_intermediate, digits=4)
 
     lime_img = np.array(pill_transf(img))
     t1 = time.time()
@@ -247,8 +299,10 @@ if __name__ == '__main__':
                                                                   random_seed=args.lime_superpixel_seed,
                                                                   fill_type=args.algo,
                                                                   num_super_pixel=args.lime_superpixel_num,
-                                                                  sav_path=save_intermediate,
+                                                                  writer=writer,
                                                                   target_category=true_class, l_map=label_map)
+    writer.close()
+    print(writer.report())
     pytorch_segments = pytorch_lime_explanation.segments
     pytorch_heatmap = np.zeros(pytorch_segments.shape)
     local_exp = pytorch_lime_explanation.local_exp
@@ -261,6 +315,8 @@ if __name__ == '__main__':
 
     # SAVE raw numpy values
     np.save(os.path.abspath(os.path.join(save_path, "mask_{}.npy".format(args.algo))), pytorch_heatmap)
+    if args.algo == 'LIMEG' and inpaint_model.cache is not None:
+        print(inpaint_model.cache.report())
 
     # Compute original output
     org_softmax = pytorch_model(pytorch_img)
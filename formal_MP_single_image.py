@@ -13,6 +13,7 @@ from skimage.transform import resize
 from PIL import ImageFilter, Image
 
 use_cuda = torch.cuda.is_available()
+device = 'cuda' if use_cuda else 'cpu'
 
 # Fixing for deterministic results
 torch.backends.cudnn.deterministic = True
@@ -51,50 +52,61 @@ def create_blurred_circular_mask(mask_shape, radius, center=None, sigma=10):
 
 
 def create_blurred_circular_mask_pyramid(mask_shape, radii, sigma=10):
+    """
+    Same masks as create_blurred_circular_mask for every radius, thresholded from a single distance grid and
+    blurred with one separable Gaussian filter over the whole stack.
+    :return: len(radii) x 3 x H x W masks
+    """
     assert (len(mask_shape) == 2)
-    num_masks = len(radii)
-    masks = np.zeros((num_masks, 3, mask_shape[0], mask_shape[1]))
-    for i in range(num_masks):
-        masks[i, :, :, :] = create_blurred_circular_mask(mask_shape, radii[i], sigma=sigma)
-    return masks
+    y_center, x_center = int(mask_shape[0] / float(2)), int(mask_shape[1] / float(2))
+    y, x = np.ogrid[-y_center:mask_shape[0] - y_center, -x_center:mask_shape[1] - x_center]
+    radii = np.asarray(radii, dtype=float)
+    grid = (x * x + y * y <= (radii * radii)[:, None, None]).astype(float)
+
+    if sigma is not None:
+        # No smoothing across the radius axis
+        grid = scipy.ndimage.gaussian_filter(grid, (0, sigma, sigma))
+    return np.repeat(grid[:, None], 3, axis=1)
 
 
-def test_circular_masks(args, model, inpaint_model, o_img, upsample, gt_category, radii=np.arange(0, 175, 5),
-                        thres=1e-2):
+# Radii tried by the circular mask initialization, MPG inpaints all of them in one network call
+CIRCULAR_RADII = np.arange(0, 175, 5)
 
+
+def test_circular_masks(args, model, inpaint_model, o_img, upsample, gt_category, radii=CIRCULAR_RADII,
+                        thres=1e-2, batch_size=18):
+    """
+    Radius of the smallest centred circle whose blurred removal drops the target probability to within thres
+    of removing the largest one. All radii and the original image are scored in batches of batch_size, MPG
+    inpaints all radii in a single generate_background call (one network call with an inpainter batch size
+    of at least len(radii)).
+    """
     masks = create_blurred_circular_mask_pyramid((args.size, args.size), radii)
     masks = 1 - masks
-    u_mask = upsample(torch.from_numpy(masks)).float().to('cuda')
+    u_mask = upsample(torch.from_numpy(masks)).float().to(device)
     num_masks = len(radii)
-    img = preprocess_image(np.float32(o_img) / 255, size)
+    img = preprocess_image(np.float32(o_img) / 255, args.size)
 
-    gradient = np.zeros((1, 1000))
-    gradient[0][gt_category] = 1
-    scores = np.zeros(num_masks)
-    batch_masked_img = []
-    for i in range(num_masks):
-        if args.algo == 'MP':
-            null_img = preprocess_image(get_blurred_img(np.float32(o_img)), args.size)
-            masked_img = img.mul(u_mask[i]) + null_img.mul(1 - u_mask[i])
-        elif args.algo == 'MPG':
-            # Use inpainted image for optimization
-            temp_inpaint_img, _ = inpaint_model.generate_background(img, u_mask[i].unsqueeze(0))
-            if args.perturb_binary:
-                thresh = max(0.5, args.thresh * (torch.max(u_mask[i]).cpu().item() + torch.min(
-                    u_mask[i]).cpu().item()))
-                u_mask[i].data = torch.where(u_mask[i].data > thresh,
-                                             torch.ones_like(u_mask[i].data),
-                                             torch.zeros_like(u_mask[i].data))
-            masked_img = img.mul(u_mask[i]) + temp_inpaint_img.mul(1 - u_mask[i])
-        else:
-            print('Invalid heatmap style!!')
-            exit(0)
+    if args.algo == 'MP':
+        null_img = preprocess_image(get_blurred_img(np.float32(o_img)), args.size)
+        masked_img = img.mul(u_mask) + null_img.mul(1 - u_mask)
+    elif args.algo == 'MPG':
+        # Use inpainted image for optimization
+        inpaint_img, _ = inpaint_model.generate_background(img.expand(num_masks, -1, -1, -1), u_mask)
+        if args.perturb_binary:
+            flat_mask = u_mask.reshape(num_masks, -1)
+            thresh = torch.clamp(args.thresh * (flat_mask.max(1)[0] + flat_mask.min(1)[0]), min=0.5)
+            u_mask = torch.where(u_mask > thresh.view(-1, 1, 1, 1), torch.ones_like(u_mask), torch.zeros_like(u_mask))
+        masked_img = img.mul(u_mask) + inpaint_img.mul(1 - u_mask)
+    else:
+        print('Invalid heatmap style!!')
+        exit(0)
 
-        outputs = torch.nn.Softmax(dim=1)(model(masked_img))
-        scores[i] = outputs[0, gt_category].cpu().detach()
-        batch_masked_img.append(masked_img)
-    img_output = torch.nn.Softmax(dim=1)(model(img)).cpu().detach()
-    orig_score = img_output[0, gt_category]
+    masked_img = torch.cat([masked_img, img])
+    with torch.no_grad():
+        outputs = torch.cat([torch.nn.Softmax(dim=1)(model(masked_img[k:k + batch_size]))[:, gt_category]
+                             for k in range(0, num_masks + 1, batch_size)]).cpu().numpy()
+    scores, orig_score = outputs[:num_masks], outputs[num_masks]
 
     percs = (scores - scores[-1]) / float(orig_score - scores[-1])
     try:
@@ -104,10 +116,163 @@ def test_circular_masks(args, model, inpaint_model, o_img, upsample, gt_category
     return radii[first_i]
 
 
-def get_blurred_img(img, radius=10):
-    img = Image.fromarray(np.uint8(img))
-    blurred_img = img.filter(ImageFilter.GaussianBlur(radius))
-    return np.array(blurred_img) / float(255)
+def optimize_masks(args, model, img, mask, categories, random_states, upsample, l1_coeffs, tv_coeffs,
+                   image_index=None, null_img=None, inpaint_model=None, writers=None, tv_beta=3, num_iter=None,
+                   step_offset=0):
+    """
+    Optimizes M perturbation masks (restarts of several image and class pairs) at once as a single batched
+    parameter tensor. The loss of every mask only depends on its own mask, so summing the losses and stepping
+    Adam on the batch gives the same masks as M separate runs.
+    :param img: N x 3 x (size + jitter) x (size + jitter) images
+    :param mask: M x 1 x h x w initial masks, 1 keeps the image
+    :param categories: M target classes
+    :param random_states: M numpy RandomStates drawing the jitter offsets of every mask
+    :param l1_coeffs: M L1 coefficients
+    :param tv_coeffs: M TV coefficients
+    :param image_index: M indices of the image of every mask, None = all masks explain the first image
+    :param null_img: blurred images of MP, same shape as img
+    :param inpaint_model: CA-inpainter of MPG, built for a batch of M
+    :param writers: optional IntermediateWriter of every image
+    :param num_iter: number of steps, None = args.num_iter
+    :param step_offset: steps taken before, e.g. by a previous resolution stage, for the intermediate steps
+    :return: M x 1 x h x w optimized masks, the M losses and target probabilities of their last step and the
+             M numbers of steps taken
+    """
+    num_masks, size, jitter = mask.shape[0], args.size, args.jitter
+    num_iter = args.num_iter if num_iter is None else num_iter
+    if image_index is None:
+        image_index = [0] * num_masks
+    mask = mask.detach().clone().requires_grad_(True)
+    # Host copy for the intermediate steps, reading the device tensor would synchronize every step
+    target_classes = [int(c) for c in categories]
+    categories = torch.tensor(categories, device=mask.device).long()
+    l1_coeffs = torch.tensor(l1_coeffs, dtype=mask.dtype, device=mask.device)
+    tv_coeffs = torch.tensor(tv_coeffs, dtype=mask.dtype, device=mask.device)
+    optimizer = torch.optim.Adam([mask], lr=args.learning_rate)
+
+    # Masks of every image, for the intermediate steps
+    members = [[m for m in range(num_masks) if image_index[m] == n] for n in range(img.shape[0])]
+
+    # Early stopping state, kept on the device and only compared every args.check_every steps
+    early_stopping = args.patience > 0
+    active = torch.ones(num_masks, dtype=torch.bool, device=mask.device)
+    stale = torch.zeros(num_masks, dtype=torch.long, device=mask.device)
+    stop_iters = torch.full((num_masks,), num_iter, dtype=torch.long, device=mask.device)
+    stop_losses = torch.zeros(num_masks, dtype=mask.dtype, device=mask.device)
+    stop_probs = torch.zeros(num_masks, dtype=mask.dtype, device=mask.device)
+    frozen_mask = mask.detach().clone()
+    window_mask, window_loss, window_prob = mask.detach().clone(), None, None
+
+    # Inpainting refresh policy of MPG: always | every:N | hamming:T
+    refresh = args.inpaint_refresh.split(':')
+    inpainted, inpainted_hole, inpaint_calls = None, None, 0
+    steps = 0
+
+    for i in range(num_iter):
+        steps = i + 1
+        if jitter != 0:
+            offsets = [(state.randint(jitter), state.randint(jitter)) for state in random_states]
+        else:
+            offsets = [(0, 0)] * num_masks
+        crops = torch.stack([img[n, :, j1:(size + j1), j2:(size + j2)] for n, (j1, j2) in zip(image_index, offsets)])
+
+        # The single channel masks are used with an RGB image, so they are duplicated to have 3 channels
+        upsampled_mask = upsample(mask)
+        upsampled_mask = upsampled_mask.expand(num_masks, 3, upsampled_mask.size(2), upsampled_mask.size(3))
+
+        if args.algo == 'MPG':
+            if refresh[0] == 'hamming':
+                # Holes of the inpainter, which thresholds every mask on its own range
+                flat_mask = upsampled_mask.data[:, 0].reshape(num_masks, -1)
+                hole = flat_mask < torch.clamp(0.5 * (flat_mask.max(1)[0] + flat_mask.min(1)[0]), min=0.5)[:, None]
+            if inpainted is None or refresh[0] == 'always' or \
+                    (refresh[0] == 'every' and i % int(refresh[1]) == 0) or \
+                    (refresh[0] == 'hamming' and
+                     (hole != inpainted_hole).float().mean(dim=1).max().item() > float(refresh[1])):
+                # Tensorflow CA-inpainter, inpainted with the continuous masks
+                background, _ = inpaint_model.generate_background(crops, upsampled_mask)
+                inpaint_calls += 1
+                if refresh[0] != 'always':
+                    # Kept in image coordinates, later steps crop it at their own jitter offsets
+                    inpainted = img[image_index].clone()
+                    for m, (j1, j2) in enumerate(offsets):
+                        inpainted[m, :, j1:(size + j1), j2:(size + j2)] = background[m]
+                    inpainted_hole = hole if refresh[0] == 'hamming' else None
+            else:
+                background = torch.stack([inpainted[m, :, j1:(size + j1), j2:(size + j2)]
+                                          for m, (j1, j2) in enumerate(offsets)])
+        elif args.algo == 'MP':
+            background = torch.stack([null_img[n, :, j1:(size + j1), j2:(size + j2)]
+                                      for n, (j1, j2) in zip(image_index, offsets)])
+        else:
+            print('Invalid heatmap style!!')
+            exit(0)
+
+        if args.perturb_binary:
+            flat_mask = upsampled_mask.data.reshape(num_masks, -1)
+            thresh = torch.clamp(args.thresh * (flat_mask.max(1)[0] + flat_mask.min(1)[0]), min=0.5)
+            upsampled_mask.data = torch.where(upsampled_mask.data > thresh.view(-1, 1, 1, 1),
+                                              torch.ones_like(upsampled_mask.data),
+                                              torch.zeros_like(upsampled_mask.data))
+        perturbated_input = crops.mul(upsampled_mask) + background.mul(1 - upsampled_mask)
+
+        optimizer.zero_grad()
+        outputs = torch.nn.Softmax(dim=1)(model(perturbated_input))
+
+        losses = l1_coeffs * torch.sum(torch.abs(1 - mask), dim=(1, 2, 3)) + \
+            tv_coeffs * tv_norm_batch(mask, tv_beta) + outputs.gather(1, categories[:, None])[:, 0]
+        losses.sum().backward()
+
+        optimizer.step()
+        mask.data.clamp_(0, 1)
+        probs = outputs.data.gather(1, categories[:, None])[:, 0]
+        stop_losses = torch.where(active, losses.detach(), stop_losses)
+        stop_probs = torch.where(active, probs, stop_probs)
+
+        if early_stopping:
+            # Stopped masks keep their value, Adam's momentum would move them even without gradient
+            mask.data = torch.where(active.view(-1, 1, 1, 1), mask.data, frozen_mask)
+            if window_loss is None:
+                window_loss, window_prob = losses.detach(), probs
+            elif (i + 1) % args.check_every == 0:
+                # A mask converged over the last window if its loss, target probability and values all
+                # changed by less than the tolerance
+                converged = ((losses.detach() - window_loss).abs() <= args.stop_tol) & \
+                            ((probs - window_prob).abs() <= args.stop_tol) & \
+                            ((mask.data - window_mask).abs().mean(dim=(1, 2, 3)) <= args.stop_tol)
+                stale = torch.where(converged, stale + 1, torch.zeros_like(stale))
+                stopped = active & (stale >= args.patience)
+                stop_iters = torch.where(stopped, torch.full_like(stop_iters, i + 1), stop_iters)
+                frozen_mask = torch.where(stopped.view(-1, 1, 1, 1), mask.data, frozen_mask)
+                active = active & ~stopped
+                window_mask, window_loss, window_prob = mask.detach().clone(), losses.detach(), probs
+
+                # The only synchronization of the early stopping
+                if not active.any():
+                    break
+
+        # Save intermediate steps, mask j of an image at step i is saved as i * (masks of the image) + j
+        if writers is not None:
+            for writer, masks in zip(writers, members):
+                step = step_offset + i
+                for j in writer.select(step * len(masks), len(masks)):
+                    writer.submit(step * len(masks) + j, perturbated_input[masks[j]], outputs.data[masks[j]],
+                                  target_classes[masks[j]])
+
+    if args.algo == 'MPG':
+        print('Inpainting: {} calls, {} of {} steps skipped'.format(inpaint_calls, steps - inpaint_calls, steps))
+    return mask.detach(), stop_losses, stop_probs, stop_iters
+
+
+def restart_coefficients(values, default, num_masks):
+    """Per-restart coefficients from a comma separated string, empty = default for every restart."""
+    if not values:
+        return [default] * num_masks
+    values = [float(v) for v in values.split(',')]
+    if len(values) != num_masks:
+        print('Expected {} comma separated coefficients, got {}!!'.format(num_masks, len(values)))
+        exit(0)
+    return values
 
 
 if __name__ == '__main__':
@@ -116,13 +281,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Processing Meaningful Perturbation data')
     parser.add_argument('--img_path', type=str,
                         default='/home/chirag/ILSVRC2012_img_val_bb/ILSVRC2012_img_val/',
-                        help='filepath for the example image')
+                        help='filepath for the example image, comma separated to optimize several images in one batch')
 
     parser.add_argument('--algo', type=str,
                         default='MP', help='MP|MPG')
 
     parser.add_argument('--mask_init', type=str,
-                        default='random', help='random|circular')
+                        default='circular', help='random|circular')
 
     parser.add_argument('--perturb_binary', type=int,
                         default=0,
@@ -135,9 +300,15 @@ if __name__ == '__main__':
     parser.add_argument('--size', type=int,
                         default=224, help='mask size to be optimized')
 
-    parser.add_argument('--true_class', type=int,
-                        default=565,
-                        help='target class of the image you want to explain')
+    parser.add_argument('--true_class', type=str,
+                        default='565',
+                        help='target class of the image you want to explain, comma separated for several images')
+
+    parser.add_argument('--explain_classes', type=str,
+                        default='', help='comma separated extra classes explained in the same batch')
+
+    parser.add_argument('--top_k', type=int,
+                        default=0, help='also explain the top-k classes of every image in the same batch')
 
     parser.add_argument('--num_iter', type=int,
                         default=300, help='enter number of optimization iterations')
@@ -165,8 +336,70 @@ if __name__ == '__main__':
     parser.add_argument('--weight_file', type=str,
                         default='/home/chirag/gpu3_codes/generative_inpainting_FIDO/model_logs/release_imagenet_256/',
                         help='path for the weight files of the inpainter model for imagenet | places365')
+
+    parser.add_argument('--backend', type=str,
+                        default='fp32', help='classifier backend: fp32 | jit (traced, frozen, channels-last) | '
+                                             'int8 (quantized, CPU, circular mask initialization only)')
+
+    parser.add_argument('--compiled_dir', type=str,
+                        default='./compiled_models', help='cache directory of the --backend jit classifiers')
+
+    parser.add_argument('--calib_images', type=str,
+                        default=CALIBRATION_IMAGES,
+                        help='comma separated calibration images or glob patterns for --backend int8')
+
+    parser.add_argument('--save_intermediate', type=str,
+                        default='reservoir:20', help='intermediate images to save: every:k | reservoir:N | off')
+
+    parser.add_argument('--inpaint_cache_dir', type=str,
+                        default='', help='directory of the persistent inpainting cache, empty = no cache')
+
+    parser.add_argument('--inpaint_cache_mb', type=int,
+                        default=2048, help='size cap of the inpainting cache directory in MB')
+    parser.add_argument('--inpainter', default='tf', type=str,
+                        help='CA-inpainter implementation: tf | torch (pytorch port loading the same checkpoint)')
+    parser.add_argument('--inpaint_frozen', type=int,
+                        default=0, help='tensorflow inpainter: run frozen inference graphs cached next to --weight_file')
+
+    parser.add_argument('--restarts', type=int,
+                        default=1, help='number of masks optimized at once in one batch, the best one is saved '
+                                        'as mask_{algo}.npy and all of them in masks_{algo}.npz. The best restart '
+                                        'has the lowest final loss, or the lowest final target probability when '
+                                        '--l1_coeffs/--tv_coeffs differ between restarts (their losses are on '
+                                        'different scales)')
+
+    parser.add_argument('--seed', type=int,
+                        default=0, help='seed of the first restart, restart k uses seed + k')
+
+    parser.add_argument('--l1_coeffs', type=str,
+                        default='', help='optional comma separated L1 coefficient of every restart')
+
+    parser.add_argument('--tv_coeffs', type=str,
+                        default='', help='optional comma separated TV coefficient of every restart')
+
+    parser.add_argument('--inpaint_refresh', type=str,
+                        default='always', help='MPG inpainting refresh: always | every:N steps | hamming:T, when the '
+                                               'fraction of changed hole pixels of a mask exceeds T')
+
+    parser.add_argument('--mask_schedule', type=str,
+                        default='', help='coarse-to-fine mask sizes and steps, e.g. 7:50,14:50,28:100,56:100, '
+                                         'empty = 28 x 28 (random init) or full size (circular init) for --num_iter')
+
+    parser.add_argument('--patience', type=int,
+                        default=0, help='stop a mask after this many converged check windows, 0 = run --num_iter')
+
+    parser.add_argument('--stop_tol', type=float,
+                        default=1e-3, help='largest loss, target probability and mean mask change of a converged '
+                                           'check window')
+
+    parser.add_argument('--check_every', type=int,
+                        default=10, help='steps of an early stopping check window')
     args = parser.parse_args()
 
+    if args.inpaint_refresh.split(':')[0] not in ('always', 'every', 'hamming'):
+        print('Invalid inpainting refresh policy!!')
+        exit(0)
+
     # PyTorch random seed
     torch.manual_seed(0)
 
@@ -193,18 +426,26 @@ if __name__ == '__main__':
         print('Invalid datasest!!')
         exit(0)
 
-    model = torch.nn.DataParallel(model).to('cuda')
+    # The mask optimization needs gradients through the classifier, so an int8 model is only used for the
+    # gradient-free circular mask initialization
+    if args.backend == 'int8':
+        init_model = CPUClassifier(quantize_model(model, 'resnet50',
+                                                  load_calibration_images(calibration_paths(args.calib_images),
+                                                                          args.size)))
+        init_model.eval()
+
+    if args.backend == 'jit':
+        # The frozen module still backpropagates to the mask
+        model = compile_model(model, 'resnet50_{}'.format(args.dataset), (3, size, size),
+                              cache_dir=args.compiled_dir, device=device)
+    else:
+        model = torch.nn.DataParallel(model).to(device)
     model.eval()
 
     for p in model.parameters():
         p.requires_grad = False
-
-    if args.algo == 'MPG':
-        # Tensorflow CA-inpainter from FIDO
-        sys.path.insert(0, './generative_inpainting')
-        from CAInpainter import CAInpainter
-
-        inpaint_model = CAInpainter(1, checkpoint_dir=args.weight_file)
+    if args.backend != 'int8':
+        init_model = model
 
     if use_cuda:
         upsample = torch.nn.UpsamplingNearest2d(size=(size, size)).to('cuda')
@@ -214,136 +455,160 @@ if __name__ == '__main__':
 
     init_time = time.time()
 
-    # Read image
-    original_img = cv2.imread(args.img_path, 1)
-
-    shape = original_img.shape
-    img = np.float32(original_img) / 255
-
-    gt_category = args.true_class
-
     # define jitter function
     jitter = args.jitter
 
-    # Path to the output folder
-    save_path = os.path.join(args.save_path, '{}'.format(args.algo), '{}'.format(args.dataset))
-    mkdir_p(os.path.join(save_path))
-
-    # Compute original output
-    org_softmax = torch.nn.Softmax(dim=1)(model(preprocess_image(img, size)))
-    eval0 = org_softmax.data[0, gt_category]
-    pill_transf = get_pil_transform()
-    o_img_path = os.path.join(save_path, 'real_{}_{:.3f}_image.jpg'
-                              .format(label_map[gt_category].split(',')[0].split(' ')[0].split('-')[0], eval0))
-    cv2.imwrite(os.path.abspath(o_img_path), cv2.cvtColor(np.array(pill_transf(get_image(args.img_path))), cv2.COLOR_BGR2RGB))
-
-    # Convert to torch variables
-    img = preprocess_image(img, size + jitter)
-
-    if use_cuda:
-        img = img.to('cuda')
-
-    # Modified
-    if args.mask_init == 'random':
-        np.random.seed(seed=0)
-        mask = np.random.rand(28, 28)
-        mask = numpy_to_torch(mask)
-    elif args.mask_init == 'circular':
-
-        # CAFFE mask_init
+    img_paths = args.img_path.split(',')
+    true_classes = [int(c) for c in args.true_class.split(',')]
+    if len(true_classes) == 1:
+        true_classes = true_classes * len(img_paths)
+
+    # Every (image, class) pair is optimized with all restarts, restart k draws its initial mask (random init)
+    # and jitter offsets from seed + k
+    num_restarts = args.restarts
+    seeds = [args.seed + k for k in range(num_restarts)]
+    restart_l1 = restart_coefficients(args.l1_coeffs, l1_coeff, num_restarts)
+    restart_tv = restart_coefficients(args.tv_coeffs, tv_coeff, num_restarts)
+
+    pairs, imgs, null_imgs, save_paths, writers = [], [], [], [], []
+    for n, (img_path, gt_category) in enumerate(zip(img_paths, true_classes)):
+        # Read image
+        original_img = cv2.imread(img_path, 1)
+        img = np.float32(original_img) / 255
+
+        # Path to the output folder, one sub folder per image when explaining several images
+        save_path = os.path.join(args.save_path, '{}'.format(args.algo), '{}'.format(args.dataset))
+        if len(img_paths) > 1:
+            save_path = os.path.join(save_path, os.path.splitext(os.path.basename(img_path))[0])
+        mkdir_p(os.path.join(save_path))
+        save_paths.append(save_path)
+
+        # Compute original output
+        org_softmax = torch.nn.Softmax(dim=1)(model(preprocess_image(img, size)))
+        eval0 = org_softmax.data[0, gt_category]
+        pill_transf = get_pil_transform()
+        o_img_path = os.path.join(save_path, 'real_{}_{:.3f}_image.jpg'
+                                  .format(label_map[gt_category].split(',')[0].split(' ')[0].split('-')[0], eval0))
+        cv2.imwrite(os.path.abspath(o_img_path), cv2.cvtColor(np.array(pill_transf(get_image(img_path))),
+                                                              cv2.COLOR_BGR2RGB))
+
+        classes = [gt_category]
+        if args.explain_classes:
+            classes.extend(int(c) for c in args.explain_classes.split(','))
+        if args.top_k > 0:
+            classes.extend(org_softmax.data[0].topk(args.top_k)[1].tolist())
+        pairs.extend((n, c, original_img) for c in dict.fromkeys(classes))
+
+        # Convert to torch variables
+        imgs.append(preprocess_image(img, size + jitter))
         if args.algo == 'MP':
-            mask_radius = test_circular_masks(args, model, model, original_img, upsample, gt_category)
-        elif args.algo == 'MPG':
-            mask_radius = test_circular_masks(args, model, inpaint_model, original_img, upsample, gt_category)
-        mask = 1 - create_blurred_circular_mask((size, size), mask_radius, center=None, sigma=10)
-        mask = resize(mask.astype(float), (size, size))
-        mask = numpy_to_torch(mask)
-    else:
-        print('Invalid mask init!!')
-        exit(0)
+            null_imgs.append(preprocess_image(get_blurred_img(np.float32(original_img), radius=10), size + jitter))
 
-    if args.algo == 'MP':
-        null_img = preprocess_image(get_blurred_img(np.float32(original_img), radius=10), size + jitter)
+        # Intermediate steps are saved from a background thread
+        writers.append(IntermediateWriter(os.path.join(save_path, 'intermediate_steps'), label_map,
+                                          policy=args.save_intermediate))
 
-    optimizer = torch.optim.Adam([mask], lr=learning_rate)
+    img = torch.cat(imgs).to(device)
+    null_img = torch.cat(null_imgs).to(device) if args.algo == 'MP' else None
 
-    for i in range(max_iterations):
-        if jitter != 0:
-            j1 = np.random.randint(jitter)
-            j2 = np.random.randint(jitter)
+    inpaint_model = None
+    if args.algo == 'MPG':
+        # Tensorflow CA-inpainter from FIDO
+        sys.path.insert(0, './generative_inpainting')
+        if args.inpainter == 'torch':
+            from CAInpainter2 import CAInpainter2 as CAInpainter
+            inpainter_options = {}
         else:
-            j1 = 0
-            j2 = 0
-
-        upsampled_mask = upsample(mask)
-
-        # The single channel mask is used with an RGB image,
-        # so the mask is duplicated to have 3 channel,
-        upsampled_mask = upsampled_mask.expand(1, 3, upsampled_mask.size(2), upsampled_mask.size(3))
-
-        if args.algo == 'MPG':
-            # Tensorflow CA-inpainter
-            inpaint_img, _ = inpaint_model.generate_background(img[:, :, j1:(size + j1), j2:(size + j2)],
-                                                              upsampled_mask)
-
-            if args.perturb_binary:
-                thresh = max(0.5, args.thresh * (torch.max(upsampled_mask).cpu().item() + torch.min(
-                    upsampled_mask).cpu().item()))
-                upsampled_mask.data = torch.where(upsampled_mask.data > thresh,
-                                                  torch.ones_like(upsampled_mask.data),
-                                                  torch.zeros_like(upsampled_mask.data))
-                perturbated_input = img[:, :, j1:(size + j1), j2:(size + j2)].mul(upsampled_mask) + \
-                                    inpaint_img.mul(1 - upsampled_mask)
-            else:
-                perturbated_input = img[:, :, j1:(size + j1), j2:(size + j2)].mul(upsampled_mask) + \
-                                    inpaint_img.mul(1 - upsampled_mask)
-
-        elif args.algo == 'MP':
-            if args.perturb_binary:
-                thresh = max(0.5, args.thresh * (torch.max(upsampled_mask).cpu().item() + torch.min(
-                    upsampled_mask).cpu().item()))
-                upsampled_mask.data = torch.where(upsampled_mask.data > thresh,
-                                                  torch.ones_like(upsampled_mask.data),
-                                                  torch.zeros_like(upsampled_mask.data))
-                perturbated_input = img[:, :, j1:(size + j1), j2:(size + j2)].mul(upsampled_mask) + \
-                                    null_img[:, :, j1:(size + j1), j2:(size + j2)].mul(
-                                        1 - upsampled_mask)
-            else:
-                perturbated_input = img[:, :, j1:(size + j1), j2:(size + j2)].mul(upsampled_mask) + \
-                                    null_img[:, :, j1:(size + j1), j2:(size + j2)].mul(
-                                        1 - upsampled_mask)
+            from CAInpainter import CAInpainter
+            inpainter_options = {'frozen': args.inpaint_frozen}
+        from inpaint_cache import InpaintCache
+
+        inpaint_cache = InpaintCache(args.inpaint_cache_dir, max_disk_mb=args.inpaint_cache_mb) \
+            if args.inpaint_cache_dir else None
+        # Large enough for all masks of a step and for the radii of the circular initialization
+        inpaint_batch = max(len(pairs) * num_restarts, len(CIRCULAR_RADII) if args.mask_init == 'circular' else 0)
+        inpaint_model = CAInpainter(inpaint_batch, checkpoint_dir=args.weight_file, cache=inpaint_cache,
+                                    **inpainter_options)
+
+    # Coarse-to-fine mask resolutions, without a schedule the initial mask resolution is kept
+    if args.mask_schedule:
+        stages = [tuple(int(v) for v in stage.split(':')) for stage in args.mask_schedule.split(',')]
+    else:
+        stages = [(None, args.num_iter)]
 
+    # Modified
+    masks, image_index, categories, random_states = [], [], [], []
+    for n, gt_category, original_img in pairs:
+        states = [np.random.RandomState(seed) for seed in seeds]
+        if args.mask_init == 'random':
+            init_size = stages[0][0] or 28
+            masks.extend(numpy_to_torch(state.rand(init_size, init_size), requires_grad=False) for state in states)
+        elif args.mask_init == 'circular':
+
+            # CAFFE mask_init, shared by all restarts which then only differ by their jitter and coefficients
+            if args.algo == 'MP':
+                mask_radius = test_circular_masks(args, init_model, model, original_img, upsample, gt_category)
+            elif args.algo == 'MPG':
+                mask_radius = test_circular_masks(args, init_model, inpaint_model, original_img, upsample,
+                                                  gt_category)
+            mask = 1 - create_blurred_circular_mask((size, size), mask_radius, center=None, sigma=10)
+            mask = resize(mask.astype(float), (size, size))
+            masks.extend([numpy_to_torch(mask, requires_grad=False)] * num_restarts)
         else:
-            print('Invalid heatmap style!!')
+            print('Invalid mask init!!')
             exit(0)
-
-        optimizer.zero_grad()
-        outputs = torch.nn.Softmax(dim=1)(model(perturbated_input))
-
-        loss = l1_coeff * torch.sum(torch.abs(1 - mask)) + tv_coeff * tv_norm(mask, tv_beta) + \
-               outputs[0, gt_category]
-        loss.backward()
-
-        optimizer.step()
-        mask.data.clamp_(0, 1)
-
-        # Create save_path for storing intermediate steps
-        path = os.path.join(save_path, 'intermediate_steps')
-        mkdir_p(path)
-
-        # Save intermediate steps
-        amax, aind = outputs.max(dim=1)
-        gt_val = outputs.data[:, gt_category]
-        temp_intermediate = np.uint8(
-                                255 * unnormalize(
-                                    np.moveaxis(perturbated_input[0, :].cpu().detach().numpy().transpose(), 0, 1)))
-        cv2.imwrite(
-            os.path.abspath(os.path.join(path, 'intermediate_{:05d}_{}_{:.3f}_{}_{:.3f}.jpg'
-                         .format(i, label_map[aind.item()].split(',')[0].split(' ')[0].split('-')[0],
-                                 amax.item(), label_map[gt_category].split(',')[0].split(' ')[0].split('-')[0],
-                                 gt_val.item()))), cv2.cvtColor(temp_intermediate, cv2.COLOR_BGR2RGB))
-
-    np.save(os.path.abspath(os.path.join(save_path, "mask_{}.npy".format(args.algo))),
-            1 - mask.cpu().detach().numpy()[0, 0, :])
+        random_states.extend(states)
+        image_index.extend([n] * num_restarts)
+        categories.extend([gt_category] * num_restarts)
+
+    masks, stop_iters, step_offset = torch.cat(masks), 0, 0
+    for mask_size, num_iter in stages:
+        scale = 1.
+        if mask_size is not None:
+            # Warm start from the previous stage, nearest neighbour upsampling keeps its perturbation. The
+            # regularizers are scaled to weigh a mask like its 28 x 28 version: L1 by area, TV by edge length
+            if mask_size != masks.shape[2]:
+                masks = torch.nn.functional.interpolate(masks, size=(mask_size, mask_size),
+                                                        mode='area' if mask_size < masks.shape[2] else 'nearest')
+            scale = 28. / mask_size
+        masks, losses, probs, stage_iters = optimize_masks(args, model, img, masks, categories, random_states,
+                                                           upsample, [c * scale ** 2 for c in restart_l1] * len(pairs),
+                                                           [c * scale for c in restart_tv] * len(pairs),
+                                                           image_index=image_index, null_img=null_img,
+                                                           inpaint_model=inpaint_model, writers=writers,
+                                                           tv_beta=tv_beta, num_iter=num_iter,
+                                                           step_offset=step_offset)
+        stop_iters, step_offset = stop_iters + stage_iters, step_offset + num_iter
+        if len(stages) > 1:
+            print('Stage {0}x{0}: {1} steps'.format(masks.shape[2], num_iter))
+    masks, losses, probs = 1 - masks.cpu().numpy()[:, 0], losses.cpu().numpy(), probs.cpu().numpy()
+    stop_iters = stop_iters.cpu().numpy()
+    # Losses of different coefficients are not comparable, the restarts are then ranked by the target probability
+    equal_coeffs = len(set(restart_l1)) == 1 and len(set(restart_tv)) == 1
+
+    for writer in writers:
+        writer.close()
+        print(writer.report())
+
+    for p, (n, gt_category, _) in enumerate(pairs):
+        # The first class of an image is its --true_class, the other ones are saved with the class in the name
+        pair_masks = masks[p * num_restarts:(p + 1) * num_restarts]
+        pair_losses = losses[p * num_restarts:(p + 1) * num_restarts]
+        pair_probs = probs[p * num_restarts:(p + 1) * num_restarts]
+        pair_iters = stop_iters[p * num_restarts:(p + 1) * num_restarts]
+        best = int(np.argmin(pair_losses if equal_coeffs else pair_probs))
+        suffix = args.algo if gt_category == true_classes[n] else '{}_{}'.format(args.algo, gt_category)
+        np.save(os.path.abspath(os.path.join(save_paths[n], "mask_{}.npy".format(suffix))), pair_masks[best])
+        if num_restarts > 1 or args.patience > 0:
+            print('{} class {}: restart losses: {}, target probabilities: {}, stopped after: {}, best restart: {}'
+                  .format(img_paths[n], gt_category, ', '.join('{:.4f}'.format(v) for v in pair_losses),
+                          ', '.join('{:.4f}'.format(v) for v in pair_probs), ', '.join(str(v) for v in pair_iters),
+                          best))
+            np.savez(os.path.abspath(os.path.join(save_paths[n], "masks_{}.npz".format(suffix))),
+                     masks=pair_masks, losses=pair_losses, probs=pair_probs, stop_iterations=pair_iters,
+                     seeds=np.array(seeds),
+                     l1_coeffs=np.array(restart_l1), tv_coeffs=np.array(restart_tv), best=best)
+    if args.algo == 'MPG' and inpaint_model.cache is not None:
+        print(inpaint_model.cache.report())
 
     # print('Time taken: {:.3f}'.format(time.time() - init_time))
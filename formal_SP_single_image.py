@@ -7,87 +7,415 @@ import argparse
 import torch.optim
 import numpy as np
 from formal_utils import *
-from skimage.util import view_as_windows
+from incremental_resnet import IncrementalResNet
 from skimage.transform import resize
 from torch.utils.data import Dataset
-import dutils
 
 use_cuda = torch.cuda.is_available()
+device = 'cuda' if use_cuda else 'cpu'
 
 # Fixing for deterministic results
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
 
 
+class occlusion_mask_loader:
+    """
+    Streams occlusion masks batch by batch instead of allocating all of them upfront.
+
+    Windows are laid out on the same grid as view_as_windows (row-major over the top-left
+    (row, col) corner of every patch) and each batch is built on demand from those coordinates,
+    so memory stays at batch_size x 3 x size x size no matter how small the stride is.
+    """
+    def __init__(self, size=224, patch_size=41, stride=3, batch_size=64, device='cpu'):
+        self.size = size
+        self.patch_size = patch_size
+        self.stride = stride
+        self.batch_size = batch_size
+        self.device = device
+
+        n = int((size - patch_size) / stride) + 1
+        self.grid_shape = (n, n)
+        rows, cols = np.meshgrid(np.arange(n) * stride, np.arange(n) * stride, indexing='ij')
+        self.coords = np.stack((rows.reshape(-1), cols.reshape(-1)), axis=1)
+        self.buffer = None
+
+    def __len__(self):
+        return int(np.ceil(len(self.coords) / float(self.batch_size)))
+
+    def __iter__(self):
+        for coords in self.coord_batches():
+            yield self.make_masks(coords)
+
+    def coord_batches(self):
+        """Yields the (row, col) corners of the windows batch by batch."""
+        for i in range(len(self)):
+            yield self.coords[i * self.batch_size:(i + 1) * self.batch_size]
+
+    def render(self, image, coords, fill=None, out=None):
+        """
+        Occluded images: the image is broadcast into a batch buffer and only the pixels of the patches are
+        written, all windows in one indexed copy.
+        :param image: 1 x 3 x size x size image, or one image per window
+        :param coords: K x 2 array of (row, col) top-left patch corners
+        :param fill: None for zeros, or a 1 x 3 x size x size / K x 3 x size x size image to take the patch from
+        :param out: K x 3 x size x size output, by default a buffer that is reused by the next call
+        :return: K x 3 x size x size occluded images
+        """
+        num = len(coords)
+        if out is None:
+            if self.buffer is None or self.buffer.shape[0] < num or self.buffer.device != image.device:
+                self.buffer = image.new_empty((max(num, self.batch_size),) + tuple(image.shape[1:]))
+            out = self.buffer[:num]
+
+        out.copy_(image.expand((num,) + tuple(image.shape[1:])))
+        windows, rows, cols = self.patch_index(coords, image.device)
+        if fill is None:
+            out[windows, :, rows, cols] = 0
+        else:
+            sources = windows if fill.shape[0] > 1 else torch.zeros_like(windows)
+            out[windows, :, rows, cols] = fill[sources, :, rows, cols].to(image.dtype)
+        return out
+
+    def patch_index(self, coords, device):
+        """
+        :param coords: K x 2 array of (row, col) top-left patch corners
+        :return: K x 1 x 1 window, K x patch_size x 1 row and K x 1 x patch_size column indices of the patch
+                 pixels, indexing a K x 3 x size x size batch with them gives its K x patch_size x patch_size x 3
+                 patches
+        """
+        coords = torch.as_tensor(coords, device=device)
+        offsets = torch.arange(self.patch_size, device=device)
+        windows = torch.arange(len(coords), device=device)[:, None, None]
+        return windows, (coords[:, 0:1] + offsets)[:, :, None], (coords[:, 1:2] + offsets)[:, None, :]
+
+    def patch_masks(self, coords, device):
+        """
+        :param coords: K x 2 array of (row, col) top-left patch corners
+        :return: K x 1 x size x size bool masks, True inside the patch
+        """
+        coords = torch.as_tensor(coords, device=device)
+        pixels = torch.arange(self.size, device=device)
+        in_rows = (pixels[None, :] >= coords[:, 0:1]) & (pixels[None, :] < coords[:, 0:1] + self.patch_size)
+        in_cols = (pixels[None, :] >= coords[:, 1:2]) & (pixels[None, :] < coords[:, 1:2] + self.patch_size)
+        return (in_rows[:, :, None] & in_cols[:, None, :]).unsqueeze(1)
+
+    def make_masks(self, coords):
+        """
+        :param coords: K x 2 array of (row, col) top-left patch corners
+        :return: K x 3 x size x size float masks, 0 inside the patch and 1 elsewhere
+        """
+        masks = 1 - self.patch_masks(coords, self.device).float()
+        return masks.expand(-1, 3, -1, -1)
+
+    def make_boxes(self, coords):
+        """
+        :param coords: K x 2 array of (row, col) top-left patch corners
+        :return: K x 4 (y0, x0, y1, x1) patch rectangles
+        """
+        coords = torch.as_tensor(coords, device=self.device)
+        return torch.cat((coords, coords + self.patch_size), dim=1)
+
+
+def load_image_list(img_path):
+    """
+    Lists the images of a multi-image run.
+    :param img_path: a directory of images, or a .txt file with one "path [class]" entry per line
+    :return: list of (path, class) tuples, class is None when not given
+    """
+    if os.path.isdir(img_path):
+        return [(os.path.join(img_path, f), None) for f in sorted(os.listdir(img_path))
+                if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+
+    image_list = []
+    with open(img_path) as list_file:
+        for line in list_file:
+            parts = line.split()
+            if len(parts) == 0:
+                continue
+            image_list.append((parts[0], int(parts[1]) if len(parts) > 1 else None))
+    return image_list
+
+
+class multi_image_occlusion_analysis:
+    """
+    Occlusion analysis over many images with a single model.
+
+    Occluded variants of all images are packed back to back into fixed-size classifier batches,
+    so a batch can hold the tail of one image and the head of the next, and the deltas are
+    scattered back into per-image heatmaps.
+    """
+    def __init__(self, net, loader, batch_size=64, heatmap_type='SP', inpaint_model=None):
+        self.model = net
+        self.loader = loader
+        self.batch_size = batch_size
+        self.heatmap_type = heatmap_type
+        self.inpaint_model = inpaint_model
+
+    def explain(self, images):
+        """
+        :param images: iterable of (key, 1 x 3 x size x size image, target class or None for top-1)
+        :return: generator of (key, target class, attribution), in the order images finish
+        """
+        num_windows = len(self.loader.coords)
+        active = {}
+        pending = []
+
+        for key, image, neuron in images:
+            # Compute original output
+            org_softmax = torch.nn.Softmax(dim=1)(self.model(image))
+            if neuron is None:
+                neuron = org_softmax.data[0].argmax().item()
+            active[key] = {'image': image, 'neuron': neuron, 'eval0': org_softmax.data[0, neuron],
+                           'heatmap': torch.zeros(num_windows, device=image.device), 'remaining': num_windows}
+
+            pending.extend((key, w) for w in range(num_windows))
+            while len(pending) >= self.batch_size:
+                for result in self._run_batch(pending[:self.batch_size], active):
+                    yield result
+                pending = pending[self.batch_size:]
+
+        if len(pending) > 0:
+            for result in self._run_batch(pending, active):
+                yield result
+
+    def _run_batch(self, items, active):
+        keys = [key for key, _ in items]
+        windows = np.array([w for _, w in items])
+
+        images = torch.cat([active[key]['image'] for key in keys])
+        coords = self.loader.coords[windows]
+
+        if self.heatmap_type == 'SP':
+            occluded = self.loader.render(images, coords)
+        elif self.heatmap_type == 'SPG':
+            masks = self.loader.make_masks(coords).to(images.device)
+            inpaint_img, _ = self.inpaint_model.generate_background(images, masks)
+            occluded = self.loader.render(images, coords, fill=inpaint_img)
+        else:
+            raise ValueError('Unknown heatmap type: {} (SP | SPG)'.format(self.heatmap_type))
+        softmax_out = torch.nn.Softmax(dim=1)(self.model(occluded))
+
+        for key in dict.fromkeys(keys):
+            state = active[key]
+            sel = np.array([k == key for k in keys])
+            state['heatmap'][torch.from_numpy(windows[sel]).to(images.device)] = \
+                state['eval0'] - softmax_out.data[torch.from_numpy(sel).to(images.device), state['neuron']]
+            state['remaining'] -= int(sel.sum())
+            if state['remaining'] == 0:
+                del active[key]
+                yield key, state['neuron'], np.reshape(state['heatmap'].cpu().numpy(), self.loader.grid_shape)
+
+
 class occlusion_analysis:
     def __init__(self, image, net, num_classes=256, img_size=227, batch_size=64,
-                 org_shape=(224, 224)):
+                 org_shape=(224, 224), inpaint_model=None, incremental=False, writer=None):
         self.image = image
         self.model = net
         self.num_classes = num_classes
         self.img_size = img_size
         self.org_shape = org_shape
         self.batch_size = batch_size
+        self.inpaint_model = inpaint_model
+        # Only the patch differs from self.image, so ResNets can reuse the cached activations of self.image
+        self.incremental = IncrementalResNet(net, image) if incremental else None
+        # IntermediateWriter for the perturbed images, None to skip them
+        self.writer = writer
+
+    def classify(self, x, boxes):
+        if self.incremental is not None:
+            return self.incremental(x, boxes)
+        return self.model(x)
 
     def explain(self, neuron, loader, l_map, heatmap_type='SP', path='./'):
+        deltas = self.explain_windows(neuron, loader, l_map, heatmap_type=heatmap_type, path=path)
+        attribution = np.reshape(deltas, loader.grid_shape)
+
+        return attribution
+
+    def explain_classes(self, neurons, loader, l_map, heatmap_type='SP', path='./', keep_full=False):
+        """
+        Attributions for several classes from a single sweep.
+        :param neurons: classes to explain, the first one is used for the intermediate images
+        :param keep_full: also return the float16 probabilities of every class
+        :return: dict class -> attribution, the float32 (windows x neurons) probability matrix and the float16
+                 (windows x all classes) probability matrix, None without keep_full
+        """
+        org_softmax = torch.nn.Softmax(dim=1)(self.model(self.image)).data[0].cpu().numpy()
+        deltas, probs, full_probs = self.explain_windows(neurons[0], loader, l_map, heatmap_type=heatmap_type,
+                                                         path=path, keep_classes=list(neurons), keep_full=keep_full)
+
+        # The first class keeps the deltas of the sweep itself
+        attributions = {neurons[0]: np.reshape(deltas, loader.grid_shape)}
+        for k, neuron in enumerate(neurons[1:], 1):
+            attributions[neuron] = np.reshape(org_softmax[neuron] - probs[:, k], loader.grid_shape)
+
+        return attributions, probs, full_probs
+
+    def explain_fills(self, neuron, loader, fills, backgrounds=None, writers=None):
+        """
+        Attributions for several fill strategies from a single sweep. The occluded images of all fills are
+        classified together, in batches of self.batch_size.
+        :param fills: 'mean' (SP, the normalized zero image), 'black', 'blur' or 'inpaint' (SPG)
+        :param backgrounds: fill -> 1 x 3 x H x W image pasted into the patch, needed for 'blur'
+        :param writers: fill -> IntermediateWriter
+        :return: dict fill -> attribution
+        """
+        # Fills that do not depend on the mask are computed once and pasted into the patches
+        backgrounds = dict(backgrounds or {})
+        backgrounds.setdefault('mean', torch.zeros_like(self.image))
+        black = torch.tensor([-0.485 / 0.229, -0.456 / 0.224, -0.406 / 0.225], device=self.image.device)
+        backgrounds.setdefault('black', black.view(1, 3, 1, 1).expand_as(self.image))
+        for fill in fills:
+            if fill not in backgrounds and fill != 'inpaint':
+                raise ValueError('No background for fill {}'.format(fill))
+        writers = writers or {}
+
+        org_softmax = torch.nn.Softmax(dim=1)(self.model(self.image))
+        eval0 = org_softmax.data[0, neuron]
+        deltas = dict((fill, []) for fill in fills)
+
+        for i, coords in enumerate(loader.coord_batches()):
+            num = len(coords)
+            boxes = loader.make_boxes(coords).repeat(len(fills), 1)
+
+            occluded = self.image.new_empty((len(fills) * num,) + tuple(self.image.shape[1:]))
+            for k, fill in enumerate(fills):
+                if fill == 'inpaint':
+                    masks = loader.make_masks(coords).to(self.image.device)
+                    background, _ = self.inpaint_model.generate_background(self.image, masks, batch_process=True)
+                else:
+                    background = backgrounds[fill]
+                loader.render(self.image, coords, fill=background, out=occluded[k * num:(k + 1) * num])
+
+            softmax_out = torch.cat([torch.nn.Softmax(dim=1)(self.classify(x, b))
+                                     for x, b in zip(occluded.split(self.batch_size), boxes.split(self.batch_size))])
+
+            start = i * loader.batch_size
+            for k, fill in enumerate(fills):
+                fill_out = softmax_out.data[k * num:(k + 1) * num]
+                deltas[fill].append(eval0 - fill_out[:, neuron])
+
+                # For saving intermediate steps
+                writer = writers.get(fill)
+                for j in writer.select(start, num) if writer is not None else []:
+                    writer.submit(start + j, occluded[k * num + j], fill_out[j], neuron)
+
+        return dict((fill, np.reshape(torch.cat(deltas[fill]).cpu().numpy(), loader.grid_shape)) for fill in fills)
+
+    def explain_windows(self, neuron, loader, l_map, heatmap_type='SP', path='./', index_offset=0,
+                        keep_classes=None, keep_full=False):
+        """
+        Evaluates every window of the loader.
+        :param index_offset: first index used for naming the intermediate images
+        :param keep_classes: also return the float32 probabilities of these classes for every window
+        :param keep_full: with keep_classes, also return the float16 probabilities of every class (None otherwise)
+        :return: flat array with one delta per loader window
+        """
 
         # Compute original output
         org_softmax = torch.nn.Softmax(dim=1)(self.model(self.image))
 
         eval0 = org_softmax.data[0, neuron]
 
-        batch_heatmap = torch.Tensor().to('cuda')
-
-        # Create save_path for storing intermediate steps
-        path = os.path.join(path, 'intermediate_steps')
-        mkdir_p(path)
+        batch_heatmap = torch.Tensor().to(self.image.device)
+        batch_probs = []
+        batch_full_probs = []
 
-        for i, data in enumerate(loader):
-            data = data.to('cuda')
+        for i, coords in enumerate(loader.coord_batches()):
+            boxes = loader.make_boxes(coords)
             if heatmap_type == 'SP':
-                softmax_out = torch.nn.Softmax(dim=1)(self.model(data * self.image))
+                occluded = loader.render(self.image, coords)
+                softmax_out = torch.nn.Softmax(dim=1)(self.classify(occluded, boxes))
                 delta = eval0 - softmax_out.data[:, neuron]
-                amax, aind = softmax_out.max(dim=1)
-                gt_val = softmax_out.data[:, neuron]
 
                 # For saving intermediate steps
-                for j in range(data.shape[0])[:1]:
-                    temp_img = np.uint8(255 * unnormalize(
-                        np.moveaxis((data[j, :] * self.image[0, :]).cpu().detach().numpy().transpose(), 0, 1)))
-                    cv2.imwrite(
-                        os.path.abspath(os.path.join(path, 'intermediate_{:05d}_{}_{:.3f}_{}_{:.3f}.jpg'
-                                     .format(i * self.batch_size + j, l_map[aind[j].item()].split(',')[0].split(' ')[0].split('-')[0],
-                                             amax[j].item(), l_map[neuron].split(',')[0].split(' ')[0].split('-')[0],
-                                             gt_val[j].item()))),
-                        cv2.cvtColor(temp_img, cv2.COLOR_BGR2RGB))
+                start = index_offset + i * loader.batch_size
+                for j in self.writer.select(start, len(coords)) if self.writer is not None else []:
+                    self.writer.submit(start + j, occluded[j], softmax_out.data[j], neuron)
 
             elif heatmap_type == 'SPG':
-                # import ipdb;ipdb.set_trace()
-                inpaint_img, _ = impant_model.generate_background(self.image, data, batch_process=True)
-                import ipdb;ipdb.set_trace()
-                inpaint_img = self.image * data + inpaint_img * (1 - data)
-                softmax_out = torch.nn.Softmax(dim=1)(self.model(inpaint_img))
+                masks = loader.make_masks(coords).to(self.image.device)
+                inpaint_img, _ = self.inpaint_model.generate_background(self.image, masks, batch_process=True)
+                inpaint_img = loader.render(self.image, coords, fill=inpaint_img)
+                softmax_out = torch.nn.Softmax(dim=1)(self.classify(inpaint_img, boxes))
                 delta = eval0 - softmax_out.data[:, neuron]
-                amax, aind = softmax_out.max(dim=1)
-                gt_val = softmax_out.data[:, neuron]
 
                 # For saving intermediate steps
-                for j in range(inpaint_img.shape[0])[:1]:
-                    temp_img = np.uint8(255 * unnormalize(
-                        np.moveaxis(inpaint_img[j, :].cpu().detach().numpy().transpose(), 0, 1)))
-                    cv2.imwrite(
-                        os.path.abspath(os.path.join(path, 'intermediate_{:05d}_{}_{:.3f}_{}_{:.3f}.jpg'
-                                     .format(i * self.batch_size + j, l_map[aind[j].item()].split(',')[0].split(' ')[0].split('-')[0],
-                                             amax[j].item(), l_map[neuron].split(',')[0].split(' ')[0].split('-')[0],
-                                             gt_val[j].item()))),
-                        cv2.cvtColor(temp_img, cv2.COLOR_BGR2RGB))
+                start = index_offset + i * loader.batch_size
+                for j in self.writer.select(start, len(coords)) if self.writer is not None else []:
+                    self.writer.submit(start + j, inpaint_img[j], softmax_out.data[j], neuron)
 
             batch_heatmap = torch.cat((batch_heatmap, delta))
-
-        sqrt_shape = len(loader)
-        attribution = np.reshape(batch_heatmap.cpu().numpy(), (sqrt_shape, sqrt_shape))
-
-        return attribution
+            if keep_classes is not None:
+                batch_probs.append(softmax_out.data[:, keep_classes])
+            if keep_full:
+                batch_full_probs.append(softmax_out.data.half())
+
+        if keep_classes is not None:
+            full_probs = torch.cat(batch_full_probs).cpu().numpy() if keep_full else None
+            return batch_heatmap.cpu().numpy(), torch.cat(batch_probs).cpu().numpy(), full_probs
+        return batch_heatmap.cpu().numpy()
+
+    def explain_adaptive(self, neuron, levels, l_map, heatmap_type='SP', path='./', threshold=None,
+                         percentile=80, device=device):
+        """
+        Coarse-to-fine occlusion.
+
+        The first level evaluates its whole grid. Every following level starts from the previous
+        level's deltas (nearest window) and only re-evaluates the windows that overlap cells
+        selected for refinement, i.e. cells whose delta exceeds threshold, or exceeds the given
+        percentile of the level's deltas when no threshold is given.
+        :param levels: list of (patch_size, stride) from coarse to fine, the last one defines the output grid
+        :return: attribution on the grid of the last level, and the number of windows queried per level
+        """
+        queries = []
+        index_offset = 0
+        for level, (patch_size, stride) in enumerate(levels):
+            loader = occlusion_mask_loader(size=self.img_size, patch_size=patch_size, stride=stride,
+                                           batch_size=self.batch_size, device=device)
+            coords = loader.coords
+
+            if level == 0:
+                values = np.zeros(len(coords))
+                selected = np.ones(len(coords), dtype=bool)
+            else:
+                # Nearest previous window along each axis, measured between window centres
+                idx = np.clip(np.round((coords + (patch_size - prev_patch) / 2.) / prev_stride), 0,
+                              np.array(prev_values.shape) - 1).astype(int)
+                values = prev_values[idx[:, 0], idx[:, 1]]
+
+                # Windows overlapping the refined region, counted with a summed-area table
+                table = np.pad(region.cumsum(0).cumsum(1), ((1, 0), (1, 0)), 'constant')
+                y, x = coords[:, 0], coords[:, 1]
+                covered = table[y + patch_size, x + patch_size] - table[y, x + patch_size] - \
+                          table[y + patch_size, x] + table[y, x]
+                selected = covered > 0
+
+            loader.coords = coords[selected]
+            if selected.any():
+                values[selected] = self.explain_windows(neuron, loader, l_map, heatmap_type=heatmap_type,
+                                                        path=path, index_offset=index_offset)
+            index_offset += int(selected.sum())
+            queries.append(int(selected.sum()))
+
+            # Pixels covered by the cells to refine at the next level
+            if threshold is not None:
+                refine = values > threshold
+            else:
+                refine = values > np.percentile(values, percentile)
+            y, x = coords[refine, 0], coords[refine, 1]
+            corners = np.zeros((self.img_size + 1, self.img_size + 1), dtype=int)
+            np.add.at(corners, (y, x), 1)
+            np.add.at(corners, (y + patch_size, x), -1)
+            np.add.at(corners, (y, x + patch_size), -1)
+            np.add.at(corners, (y + patch_size, x + patch_size), 1)
+            region = (corners.cumsum(0).cumsum(1)[:-1, :-1] > 0).astype(int)
+
+            prev_values = np.reshape(values, loader.grid_shape)
+            prev_patch, prev_stride = patch_size, stride
+
+        return prev_values, queries
 
 
 if __name__ == '__main__':
@@ -96,7 +424,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Processing Meaningful Perturbation data')
     parser.add_argument('--img_path', type=str,
                         default='/home/chirag/ILSVRC2012_img_val_bb/ILSVRC2012_img_val/',
-                        help='filepath for the example image')
+                        help='filepath for the example image, or a directory / .txt list of images '
+                             'for a multi-image run')
 
     parser.add_argument('--algo', type=str,
                         default='SPG', help='SP|SPG')
@@ -111,11 +440,61 @@ if __name__ == '__main__':
                         default=3, help='stride size for occlusion')
 
     parser.add_argument('--batch_size', type=int,
-                        default=32, help='batch size')
+                        default=32, help='batch size, 0 picks the largest batch that fits --mem_budget')
+
+    parser.add_argument('--mem_budget', type=float,
+                        default=2048, help='memory budget in MB per batch for --batch_size 0')
+
+    parser.add_argument('--adaptive_levels', type=str,
+                        default='',
+                        help='coarse-to-fine occlusion, comma separated patch:stride levels run before the '
+                             '--patch_size/--stride level, e.g. 77:24,57:12')
+
+    parser.add_argument('--refine_percentile', type=float,
+                        default=80, help='adaptive mode refines cells above this percentile of the deltas')
+
+    parser.add_argument('--refine_threshold', type=float,
+                        default=None, help='adaptive mode refines cells with a delta above this value instead')
+
+    parser.add_argument('--incremental', type=int,
+                        default=0, help='recompute only the receptive field of each patch (ResNets only)')
+
+    parser.add_argument('--incremental_tol', type=float,
+                        default=1e-2, help='largest logit difference to full forward passes accepted for --incremental')
+
+    parser.add_argument('--backend', type=str,
+                        default='fp32', help='classifier backend: fp32 | int8 (statically quantized, runs on the CPU) | '
+                                             'jit (traced, frozen, channels-last)')
+
+    parser.add_argument('--compiled_dir', type=str,
+                        default='./compiled_models', help='cache directory of the --backend jit classifiers')
+
+    parser.add_argument('--calib_images', type=str,
+                        default=CALIBRATION_IMAGES,
+                        help='comma separated calibration images or glob patterns for --backend int8')
+
+    parser.add_argument('--fills', type=str,
+                        default='', help='comma separated fills explained in one sweep: mean (SP) | black | blur | inpaint (SPG)')
+
+    parser.add_argument('--save_intermediate', type=str,
+                        default='reservoir:20', help='intermediate images to save: every:k | reservoir:N | off')
+
+    parser.add_argument('--pixel_map', type=int,
+                        default=1, help='also save a pixel resolution map averaging the windows covering each pixel')
+
+    parser.add_argument('--explain_classes', type=str,
+                        default='', help='comma separated extra classes explained in the same sweep')
+
+    parser.add_argument('--top_k', type=int,
+                        default=0, help='also explain the top-k classes of the original image in the same sweep')
+
+    parser.add_argument('--keep_full_probs', type=int,
+                        default=0, help='also store the float16 probabilities of every class (full_probs)')
 
     parser.add_argument('--true_class', type=int,
                         default=565,
-                        help='target class of the image you want to explain')
+                        help='target class of the image you want to explain '
+                             '(-1 explains the top-1 class in multi-image runs)')
 
     parser.add_argument('--dataset', type=str,
                         default='imagenet', help='dataset to run on imagenet | places365')
@@ -124,11 +503,37 @@ if __name__ == '__main__':
                         default='./',
                         help='path for saving results')
 
+    parser.add_argument('--inpaint_roi', type=int,
+                        default=0, help='SPG only inpaints a crop around each patch with this much context, 0 = full frame')
+
     parser.add_argument('--weight_file', type=str,
                         default='/home/chirag/gpu3_codes/generative_inpainting_FIDO/model_logs/release_imagenet_256/',
                         help='path for the weight files of the inpainter model for imagenet | places365')
+
+    parser.add_argument('--inpaint_cache_dir', type=str,
+                        default='', help='directory of the persistent inpainting cache, empty = no cache')
+
+    parser.add_argument('--inpaint_cache_mb', type=int,
+                        default=2048, help='size cap of the inpainting cache directory in MB')
+    parser.add_argument('--inpainter', default='tf', type=str,
+                        help='CA-inpainter implementation: tf | torch (pytorch port loading the same checkpoint)')
+    parser.add_argument('--inpaint_frozen', type=int,
+                        default=0, help='tensorflow inpainter: run frozen inference graphs cached next to --weight_file')
     args = parser.parse_args()
 
+    if (args.adaptive_levels or args.fills) and (args.explain_classes or args.top_k > 0 or args.keep_full_probs):
+        print('--explain_classes, --top_k and --keep_full_probs cannot be combined with --adaptive_levels or --fills!!')
+        exit(0)
+    if args.adaptive_levels and args.fills:
+        print('--fills cannot be combined with --adaptive_levels!!')
+        exit(0)
+    multi_image = os.path.isdir(args.img_path) or args.img_path.endswith('.txt')
+    if multi_image and (args.fills or args.adaptive_levels or args.explain_classes or args.top_k > 0 or
+                        args.keep_full_probs or args.incremental):
+        print('--fills, --adaptive_levels, --explain_classes, --top_k, --keep_full_probs and --incremental '
+              'need a single --img_path!!')
+        exit(0)
+
     if args.dataset == 'imagenet':
 
         model = load_model(arch_name='resnet50')
@@ -146,46 +551,103 @@ if __name__ == '__main__':
         print('Invalid datasest!!')
         exit(0)
 
-    model = torch.nn.DataParallel(model).to('cuda')
+    # Eager model, used to estimate the activation memory
+    eager_model = model
+
+    if args.backend == 'int8':
+        model = CPUClassifier(quantize_model(model, 'resnet50',
+                                             load_calibration_images(calibration_paths(args.calib_images), args.size)))
+    elif args.backend == 'jit':
+        model = compile_model(model, 'resnet50_{}'.format(args.dataset), (3, args.size, args.size),
+                              cache_dir=args.compiled_dir, device=device)
+    else:
+        model = torch.nn.DataParallel(model).to(device)
     model.eval()
 
     for p in model.parameters():
         p.requires_grad = False
 
-    batch_size = int((224 - args.patch_size) / args.stride) + 1
-
-    # Create all occlusion masks initially to save time
-    # Create mask
-    input_shape = (3, args.size, args.size)
-    total_dim = np.prod(input_shape)
-    index_matrix = np.arange(total_dim).reshape(input_shape)
-    idx_patches = view_as_windows(index_matrix, (3, args.patch_size, args.patch_size), args.stride).reshape((-1,) +
-                                                                                                            (3,
-                                                                                                             args.patch_size,
-                                                                                                             args.patch_size))
-
-    # Start perturbation loop
-    batch_size = int((args.size - args.patch_size) / args.stride) + 1
-    batch_mask = torch.zeros(((idx_patches.shape[0],) + input_shape), device='cuda')
-    total_dim = np.prod(input_shape)
-    for i, p in enumerate(idx_patches):
-        mask = torch.ones(total_dim, device='cuda')
-        mask[p.reshape(-1)] = 0  # occ_val
-        batch_mask[i] = mask.reshape(input_shape)
-
-    trainloader = torch.utils.data.DataLoader(batch_mask.cpu(), batch_size=batch_size, shuffle=False,
-                                              num_workers=0)
-    del mask
-    del batch_mask
-
-    if args.algo == 'SPG':
+    if args.incremental and args.backend != 'fp32':
+        print('Incremental inference needs the eager fp32 model, using full forward passes')
+        args.incremental = 0
 
-        # Tensorflow CA-inpainter from FIDO
-        sys.path.insert(0, './generative_inpainting_pytorch/')
-        from CAInpainter2 import CAInpainter
+    fills = args.fills.split(',') if args.fills else []
+    use_inpainter = args.algo == 'SPG' or 'inpaint' in fills
+    # Output folder of every fill
+    fill_algos = {'mean': 'SP', 'black': 'SP-black', 'blur': 'SP-blur', 'inpaint': 'SPG'}
 
-        impant_model = CAInpainter(batch_size, checkpoint_dir=args.weight_file)
-        impant_model.to('cuda')
+    if use_inpainter:
+        # Tensorflow CA-inpainter from FIDO
+        sys.path.insert(0, './generative_inpainting/')
+        if args.inpainter == 'torch':
+            from CAInpainter2 import CAInpainter2 as CAInpainter
+            inpainter_options = {}
+        else:
+            from CAInpainter import CAInpainter
+            inpainter_options = {'frozen': args.inpaint_frozen}
+        from inpaint_cache import InpaintCache
+
+    # Occlusion masks are generated lazily per batch from the patch coordinates
+    trainloader = occlusion_mask_loader(size=args.size, patch_size=args.patch_size, stride=args.stride,
+                                        batch_size=args.batch_size, device=device)
+    num_windows = len(trainloader.coords)
+
+    if args.batch_size > 0:
+        batch_size = args.batch_size
+    else:
+        # Each occluded sample also holds its mask and the occluded input
+        extra_bytes = 2 * 4 * 3 * args.size * args.size
+        if use_inpainter:
+            extra_bytes += CAInpainter.memory_per_sample()
+        batch_size = auto_batch_size(eager_model, (3, args.size, args.size), args.mem_budget,
+                                     extra_bytes=extra_bytes, max_batch=num_windows)
+        print('Batch size: {}'.format(batch_size))
+    # With several fills every mask yields one classifier input per fill
+    trainloader.batch_size = max(batch_size // len(fills), 1) if fills else batch_size
+
+    if use_inpainter:
+        inpaint_cache = InpaintCache(args.inpaint_cache_dir, max_disk_mb=args.inpaint_cache_mb) \
+            if args.inpaint_cache_dir else None
+        impant_model = CAInpainter(batch_size, checkpoint_dir=args.weight_file, roi_context=args.inpaint_roi,
+                                   cache=inpaint_cache, **inpainter_options)
+        if use_cuda:
+            impant_model.cuda()
+
+    if multi_image:
+        # Model and label map are loaded once for the whole run
+        image_list = load_image_list(args.img_path)
+        save_path = os.path.join(args.save_path, '{}'.format(args.algo), '{}'.format(args.dataset))
+
+        def iterate_images():
+            for path, gt_category in image_list:
+                if gt_category is None and args.true_class >= 0:
+                    gt_category = args.true_class
+                img = preprocess_image(np.float32(cv2.imread(path, 1)) / 255, args.size)
+                yield path, img.to(device), gt_category
+
+        with torch.no_grad():
+            if use_inpainter and args.inpaint_roi > 0 and len(image_list) > 0:
+                # Check the crop inpainting against full-frame inpainting on the first batch of the first image
+                _, img, _ = next(iterate_images())
+                masks = trainloader.make_masks(trainloader.coords[:batch_size])
+                hole_diff, full_time, roi_time = impant_model.roi_quality(img, masks, batch_process=True)
+                print('ROI inpainting: mean hole difference {:.2f}/255, {:.3f}s full frame, {:.3f}s crops'.format(
+                    hole_diff, full_time, roi_time))
+            heatmap_occ = multi_image_occlusion_analysis(model, trainloader, batch_size=batch_size,
+                                                         heatmap_type=args.algo,
+                                                         inpaint_model=impant_model if args.algo == 'SPG' else None)
+            for path, gt_category, heatmap in heatmap_occ.explain(iterate_images()):
+                image_save_path = os.path.join(save_path, os.path.splitext(os.path.basename(path))[0])
+                mkdir_p(image_save_path)
+                np.save(os.path.abspath(os.path.join(image_save_path, 'mask_{}.npy'.format(args.algo))), heatmap)
+                if args.pixel_map:
+                    np.save(os.path.abspath(os.path.join(image_save_path, 'pixel_mask_{}.npy'.format(args.algo))),
+                            occlusion_to_pixel_map(heatmap, trainloader.coords, args.patch_size,
+                                                   args.size))
+                print('{}: {}'.format(path, label_map[gt_category]))
+        if args.algo == 'SPG' and impant_model.cache is not None:
+            print(impant_model.cache.report())
+        exit(0)
 
     init_time = time.time()
 
@@ -199,8 +661,7 @@ if __name__ == '__main__':
     # Convert to torch variables
     img = preprocess_image(img, args.size)
 
-    if use_cuda:
-        img = img.to('cuda')
+    img = img.to(device)
 
     # Path to the output folder
     save_path = os.path.join(args.save_path, '{}'.format(args.algo), '{}'.format(args.dataset))
@@ -219,13 +680,105 @@ if __name__ == '__main__':
     with torch.no_grad():
         # Occlusion class
         heatmap_occ = occlusion_analysis(img, net=model, num_classes=1000, img_size=args.size,
-                                         batch_size=batch_size, org_shape=shape)
+                                         batch_size=batch_size, org_shape=shape,
+                                         inpaint_model=impant_model if use_inpainter else None,
+                                         incremental=args.incremental,
+                                         # With --fills every fill has its own writer
+                                         writer=None if fills else
+                                         IntermediateWriter(os.path.join(save_path, 'intermediate_steps'),
+                                                            label_map, policy=args.save_intermediate))
+        if heatmap_occ.incremental is not None:
+            # Check the incremental forward pass against full forward passes on the first batch
+            coords = trainloader.coords[:batch_size]
+            max_diff = heatmap_occ.incremental.validate(trainloader.render(img, coords),
+                                                        trainloader.make_boxes(coords))
+            print('Incremental inference max logit difference: {:.2e}'.format(max_diff))
+            if max_diff > args.incremental_tol:
+                print('Difference above {}, using full forward passes'.format(args.incremental_tol))
+                heatmap_occ.incremental = None
+        if use_inpainter and args.inpaint_roi > 0:
+            # Check the crop inpainting against full-frame inpainting on the first batch
+            masks = trainloader.make_masks(trainloader.coords[:batch_size])
+            hole_diff, full_time, roi_time = impant_model.roi_quality(img, masks, batch_process=True)
+            print('ROI inpainting: mean hole difference {:.2f}/255, {:.3f}s full frame, {:.3f}s crops'.format(
+                hole_diff, full_time, roi_time))
         for stride in [args.stride]:
             for p_size in [args.patch_size]:
-                heatmap = heatmap_occ.explain(neuron=gt_category, loader=trainloader,
-                                              heatmap_type=args.algo, path=save_path, l_map=label_map)
+                if args.adaptive_levels:
+                    levels = [tuple(int(v) for v in level.split(':')) for level in args.adaptive_levels.split(',')]
+                    levels.append((p_size, stride))
+                    heatmap, queries = heatmap_occ.explain_adaptive(neuron=gt_category, levels=levels,
+                                                                    heatmap_type=args.algo, path=save_path,
+                                                                    l_map=label_map,
+                                                                    threshold=args.refine_threshold,
+                                                                    percentile=args.refine_percentile)
+                    for (level_patch, level_stride), num_queries in zip(levels, queries):
+                        print('Level patch {} stride {}: {} queries'.format(level_patch, level_stride, num_queries))
+                    print('Total: {} queries, dense grid: {}'.format(sum(queries), num_windows))
+                elif fills:
+                    # One sweep, one heatmap per fill, saved in the folder of the matching algo
+                    fill_paths = dict((fill, os.path.join(args.save_path, fill_algos[fill], args.dataset))
+                                      for fill in fills)
+                    writers = dict((fill, IntermediateWriter(os.path.join(fill_paths[fill], 'intermediate_steps'),
+                                                             label_map, policy=args.save_intermediate))
+                                   for fill in fills)
+                    backgrounds = {}
+                    if 'blur' in fills:
+                        backgrounds['blur'] = preprocess_image(get_blurred_img(np.float32(original_img), radius=10),
+                                                               args.size).to(device)
+                    heatmaps = heatmap_occ.explain_fills(gt_category, trainloader, fills, backgrounds=backgrounds,
+                                                         writers=writers)
+                    for fill in fills:
+                        mkdir_p(fill_paths[fill])
+                        cv2.imwrite(os.path.abspath(os.path.join(fill_paths[fill], 'real_{}_{:.3f}_image.jpg'.format(
+                            label_map[gt_category].split(',')[0].split(' ')[0].split('-')[0], eval0))),
+                            cv2.cvtColor(np.array(pill_transf(get_image(args.img_path))), cv2.COLOR_BGR2RGB))
+                        np.save(os.path.abspath(os.path.join(fill_paths[fill], 'mask_{}.npy'.format(fill_algos[fill]))),
+                                heatmaps[fill])
+                        if args.pixel_map:
+                            np.save(os.path.abspath(os.path.join(fill_paths[fill],
+                                                                 'pixel_mask_{}.npy'.format(fill_algos[fill]))),
+                                    occlusion_to_pixel_map(heatmaps[fill], trainloader.coords, p_size, args.size))
+                        writers[fill].close()
+                        print('{}: {}'.format(fill, writers[fill].report()))
+                    continue
+                elif args.explain_classes or args.top_k > 0 or args.keep_full_probs:
+                    # One sweep, one heatmap per class
+                    classes = [gt_category]
+                    if args.explain_classes:
+                        classes.extend(int(c) for c in args.explain_classes.split(','))
+                    if args.top_k > 0:
+                        classes.extend(org_softmax.data[0].topk(args.top_k)[1].tolist())
+                    classes = list(dict.fromkeys(classes))
+
+                    heatmaps, probs, full_probs = heatmap_occ.explain_classes(classes, loader=trainloader,
+                                                                              heatmap_type=args.algo, path=save_path,
+                                                                              l_map=label_map,
+                                                                              keep_full=args.keep_full_probs)
+                    for neuron in classes:
+                        np.save(os.path.abspath(os.path.join(save_path, 'mask_{}_{}.npy'.format(args.algo, neuron))),
+                                heatmaps[neuron])
+                    saved = dict(probs=probs, classes=np.array(classes), grid_shape=trainloader.grid_shape)
+                    if full_probs is not None:
+                        saved['full_probs'] = full_probs
+                    np.savez_compressed(os.path.abspath(os.path.join(save_path, 'probs_{}.npz'.format(args.algo))),
+                                        **saved)
+                    heatmap = heatmaps[gt_category]
+                else:
+                    heatmap = heatmap_occ.explain(neuron=gt_category, loader=trainloader,
+                                                  heatmap_type=args.algo, path=save_path, l_map=label_map)
                 np.save(
                     os.path.abspath(os.path.join(save_path, 'mask_{}.npy'.format(args.algo))),
                     heatmap)
+                if args.pixel_map:
+                    np.save(os.path.abspath(os.path.join(save_path, 'pixel_mask_{}.npy'.format(args.algo))),
+                            occlusion_to_pixel_map(heatmap, trainloader.coords, p_size, args.size))
+
+        if heatmap_occ.writer is not None:
+            heatmap_occ.writer.close()
+            print(heatmap_occ.writer.report())
+
+    if use_inpainter and impant_model.cache is not None:
+        print(impant_model.cache.report())
 
     # print('Time taken: {:.3f}'.format(time.time() - init_time))
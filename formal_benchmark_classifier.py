@@ -0,0 +1,65 @@
+import time
+import torch
+import argparse
+from formal_utils import *
+
+
+def images_per_second(model, batch, num_iters):
+    with torch.no_grad():
+        # Warm up, the first calls of a traced module also run its optimization passes
+        for _ in range(2):
+            model(batch)
+        start = time.time()
+        for _ in range(num_iters):
+            model(batch)
+    return num_iters * batch.shape[0] / (time.time() - start)
+
+
+if __name__ == '__main__':
+
+    # Throughput of the classifier backends of the formal_*_single_image.py scripts on the CPU
+    parser = argparse.ArgumentParser(description='Benchmark of the eager, compiled and quantized classifiers')
+    parser.add_argument('--arch', type=str,
+                        default='resnet50', help='googlenet | inceptionv3 | resnet50')
+
+    parser.add_argument('--size', type=int,
+                        default=224, help='input size')
+
+    parser.add_argument('--batch_sizes', type=str,
+                        default='1,16,64', help='comma separated batch sizes')
+
+    parser.add_argument('--num_iters', type=int,
+                        default=10, help='timed forward passes per batch size')
+
+    parser.add_argument('--num_threads', type=int,
+                        default=0, help='torch CPU threads, 0 = default')
+
+    parser.add_argument('--int8', type=int,
+                        default=0, help='also benchmark the quantized backend')
+
+    parser.add_argument('--compiled_dir', type=str,
+                        default='./compiled_models', help='cache directory of the compiled classifiers')
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    model = load_model(arch_name=args.arch).cpu().eval()
+    input_shape = (3, args.size, args.size)
+    backends = [('eager', model)]
+
+    start = time.time()
+    compiled = compile_model(model, '{}_imagenet'.format(args.arch), input_shape, cache_dir=args.compiled_dir)
+    print('Compiled model ready in {:.2f}s (cached in {})'.format(time.time() - start, args.compiled_dir))
+    backends.append(('jit', compiled))
+
+    if args.int8:
+        calibration_images = [torch.randn((1,) + input_shape) for _ in range(4)]
+        backends.append(('int8', quantize_model(load_model(arch_name=args.arch), args.arch, calibration_images)))
+
+    print('batch | ' + ' | '.join('{} img/s'.format(name) for name, _ in backends) + ' | jit speedup')
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        batch = torch.randn((batch_size,) + input_shape)
+        speeds = [images_per_second(m, batch, args.num_iters) for _, m in backends]
+        print('{} | '.format(batch_size) + ' | '.join('{:.1f}'.format(v) for v in speeds) +
+              ' | {:.2f}x'.format(speeds[1] / speeds[0]))
@@ -46,7 +46,11 @@ if __name__ == '__main__':
     labels = [' '.join(o_img_path.split('_')[1:3])]
 
     # Read generated heatmap
-    heatmap_path = [f for f in os.listdir(os.path.join(args.result_path, args.dataset)) if f.endswith('.npy')][0]
+    heatmap_path = 'pixel_mask_{}.npy'.format(args.algo)
+    if not os.path.exists(os.path.join(args.result_path, args.dataset, heatmap_path)):
+        heatmap_path = 'mask_{}.npy'.format(args.algo)
+    if not os.path.exists(os.path.join(args.result_path, args.dataset, heatmap_path)):
+        heatmap_path = [f for f in os.listdir(os.path.join(args.result_path, args.dataset)) if f.endswith('.npy')][0]
     heatmap = resize(np.load(os.path.join(args.result_path, args.dataset, heatmap_path)), (224, 224))
 
     # Read intermediate perturbed images
@@ -0,0 +1,104 @@
+import os
+import cv2
+import time
+import torch
+import argparse
+import numpy as np
+from scipy.stats import spearmanr
+from formal_utils import *
+from formal_SP_single_image import occlusion_analysis, occlusion_mask_loader
+
+
+def explain(model, img, gt_category, loader, label_map):
+    heatmap_occ = occlusion_analysis(img, net=model, num_classes=1000, img_size=img.shape[2],
+                                     batch_size=loader.batch_size)
+    start = time.time()
+    with torch.no_grad():
+        heatmap = heatmap_occ.explain(neuron=gt_category, loader=loader, l_map=label_map)
+    return heatmap, time.time() - start
+
+
+if __name__ == '__main__':
+
+    # Compares the int8 backend of the formal_*_single_image.py scripts against fp32 on the CPU
+    parser = argparse.ArgumentParser(description='Attribution fidelity of the quantized classifier')
+    parser.add_argument('--img_paths', type=str,
+                        default='example.JPEG,example_2.JPEG', help='comma separated images to compare on')
+
+    parser.add_argument('--calib_images', type=str,
+                        default=CALIBRATION_IMAGES,
+                        help='comma separated calibration images or glob patterns, disjoint from --img_paths')
+
+    parser.add_argument('--dataset', type=str,
+                        default='imagenet', help='dataset to run on imagenet | places365')
+
+    parser.add_argument('--size', type=int,
+                        default=224, help='mask size to be optimized')
+
+    parser.add_argument('--patch_size', type=int,
+                        default=41, help='SP patch size')
+
+    parser.add_argument('--stride', type=int,
+                        default=3, help='SP stride')
+
+    parser.add_argument('--batch_size', type=int,
+                        default=64, help='SP batch size')
+
+    parser.add_argument('--save_path', type=str,
+                        default='', help='optional .csv file for the report')
+    args = parser.parse_args()
+
+    calib_paths = calibration_paths(args.calib_images)
+    # Agreement measured on calibration images would be in-sample
+    overlap = set(os.path.abspath(p) for p in calib_paths) & set(os.path.abspath(p) for p in args.img_paths.split(','))
+    if overlap:
+        print('--img_paths must not be calibration images: {}!!'.format(', '.join(sorted(overlap))))
+        exit(0)
+
+    if args.dataset == 'imagenet':
+        model = load_model(arch_name='resnet50')
+        label_map = load_imagenet_label_map()
+    elif args.dataset == 'places365':
+        model = load_model_places365(arch_name='resnet50')
+        label_map = load_class_label()
+    else:
+        print('Invalid datasest!!')
+        exit(0)
+
+    model = model.cpu().eval()
+    for p in model.parameters():
+        p.requires_grad = False
+    qmodel = quantize_model(model, 'resnet50', load_calibration_images(calib_paths, args.size)).eval()
+
+    loader = occlusion_mask_loader(size=args.size, patch_size=args.patch_size, stride=args.stride,
+                                   batch_size=args.batch_size, device='cpu')
+
+    rows = []
+    for path in args.img_paths.split(','):
+        img = preprocess_image(np.float32(cv2.imread(path, 1)) / 255, args.size).cpu().float()
+        with torch.no_grad():
+            probs = torch.nn.Softmax(dim=1)(model(img))[0]
+            qprobs = torch.nn.Softmax(dim=1)(qmodel(img))[0]
+        gt_category = probs.argmax().item()
+
+        heatmap, fp32_time = explain(model, img, gt_category, loader, label_map)
+        qheatmap, int8_time = explain(qmodel, img, gt_category, loader, label_map)
+
+        rows.append((os.path.basename(path), label_map[gt_category].split(',')[0],
+                     int(qprobs.argmax().item() == gt_category), probs[gt_category].item(),
+                     qprobs[gt_category].item(), np.corrcoef(heatmap.reshape(-1), qheatmap.reshape(-1))[0, 1],
+                     spearmanr(heatmap.reshape(-1), qheatmap.reshape(-1))[0], fp32_time, int8_time))
+
+    header = ('image', 'class', 'top1_agree', 'fp32_prob', 'int8_prob', 'pearson', 'spearman', 'fp32_s', 'int8_s')
+    print(' | '.join(header))
+    for row in rows:
+        print('{} | {} | {} | {:.3f} | {:.3f} | {:.4f} | {:.4f} | {:.1f} | {:.1f}'.format(*row))
+    print('Top-1 agreement: {:.3f}, mean heatmap pearson: {:.4f}, mean speedup: {:.2f}x'.format(
+        np.mean([row[2] for row in rows]), np.mean([row[5] for row in rows]),
+        np.mean([row[7] / row[8] for row in rows])))
+
+    if args.save_path:
+        with open(args.save_path, 'w') as report:
+            report.write(','.join(header) + '\n')
+            for row in rows:
+                report.write(','.join(str(v) for v in row) + '\n')
@@ -1,5 +1,11 @@
 import os
 import cv2
+import copy
+import glob
+import queue
+import hashlib
+import random
+import threading
 import torch
 import numpy as np
 import matplotlib
@@ -8,7 +14,7 @@ import torch.optim
 from matplotlib import cm
 from torchvision import models
 import matplotlib.pyplot as plt
-from PIL import Image
+from PIL import Image, ImageFilter
 import torchvision.transforms as transforms
 from matplotlib.colors import ListedColormap
 
@@ -51,6 +57,18 @@ def tv_norm(input, tv_beta):
     return row_grad + col_grad
 
 
+def tv_norm_batch(input, tv_beta):
+    """
+    tv_norm of every mask of a batch.
+    :param input: K x 1 x H x W masks
+    :return: K total variations
+    """
+    img = input[:, 0]
+    row_grad = torch.abs((img[:, :-1, :] - img[:, 1:, :])).pow(tv_beta).sum(dim=(1, 2))
+    col_grad = torch.abs((img[:, :, :-1] - img[:, :, 1:])).pow(tv_beta).sum(dim=(1, 2))
+    return row_grad + col_grad
+
+
 def unnormalize(img):
     means = [0.485, 0.456, 0.406]
     stds = [0.229, 0.224, 0.225]
@@ -98,6 +116,335 @@ def load_model_places365(arch_name='resnet50'):
     return model
 
 
+class CPUClassifier(torch.nn.Module):
+    """
+    Runs a CPU-only classifier (e.g. a quantized one) on inputs from any device.
+    """
+    def __init__(self, model):
+        super(CPUClassifier, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x.cpu()).to(x.device)
+
+    def _apply(self, fn, *args, **kwargs):
+        # The wrapped model stays on the CPU, e.g. through .to('cuda')
+        return self
+
+
+# ImageNet validation photos bundled with the inpainter, disjoint from the images the scripts explain
+CALIBRATION_IMAGES = 'generative_inpainting/examples/imagenet/*_input.png'
+
+
+def calibration_paths(calib_images):
+    """
+    :param calib_images: comma separated image paths or glob patterns, empty entries are skipped
+    :return: list of image paths
+    """
+    return [path for pattern in calib_images.split(',') if pattern
+            for path in (sorted(glob.glob(pattern)) or [pattern])]
+
+
+def load_calibration_images(paths, size=224):
+    """Preprocessed CPU images used to calibrate quantized models."""
+    return [preprocess_image(np.float32(cv2.imread(path, 1)) / 255, size).cpu() for path in paths]
+
+
+def _version(version):
+    return tuple(int(v) for v in version.split('+')[0].split('.')[:2])
+
+
+def check_versions(feature, torch_version, torchvision_version=None):
+    """
+    Raises a RuntimeError naming the feature when the installed torch / torchvision are older than required.
+    :param torch_version: minimal torch version, e.g. '1.8'
+    """
+    import torchvision
+    if _version(torch.__version__) < _version(torch_version) or \
+            (torchvision_version and _version(torchvision.__version__) < _version(torchvision_version)):
+        raise RuntimeError('{} needs torch>={}{} (installed: torch {}, torchvision {})'.format(
+            feature, torch_version, ' and torchvision>={}'.format(torchvision_version) if torchvision_version else '',
+            torch.__version__, torchvision.__version__))
+
+
+def quantize_model(model, arch_name, calibration_images, backend='fbgemm'):
+    """
+    Statically quantized int8 copy of a classifier from load_model / load_model_places365.
+    :param model: fp32 model, its weights are copied into the quantizable torchvision architecture
+    :param calibration_images: iterable of 1 x 3 x H x W preprocessed images to calibrate the activation ranges
+    :param backend: quantized engine, fbgemm (x86) | qnnpack (ARM)
+    :return: CPU-only int8 model
+    """
+    check_versions('The int8 backend', '1.3', '0.5')
+    from torchvision.models import quantization
+
+    model = model.cpu().eval()
+    if arch_name == 'resnet50':
+        qmodel = quantization.resnet50(quantize=False, num_classes=model.fc.out_features)
+    elif arch_name == 'googlenet':
+        qmodel = quantization.googlenet(quantize=False, num_classes=model.fc.out_features, aux_logits=False,
+                                        transform_input=model.transform_input, init_weights=False)
+    elif arch_name == 'inceptionv3':
+        qmodel = quantization.inception_v3(quantize=False, num_classes=model.fc.out_features,
+                                           aux_logits=model.aux_logits, transform_input=model.transform_input,
+                                           init_weights=False)
+    else:
+        raise ValueError('No quantizable version of {}'.format(arch_name))
+    qmodel.load_state_dict(model.state_dict())
+    qmodel.eval()
+
+    torch.backends.quantized.engine = backend
+    qmodel.fuse_model()
+    qmodel.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(qmodel, inplace=True)
+    with torch.no_grad():
+        for image in calibration_images:
+            qmodel(image.cpu().float())
+    torch.quantization.convert(qmodel, inplace=True)
+    return qmodel
+
+
+class ChannelsLast(torch.nn.Module):
+    """
+    Feeds channels-last inputs to a model whose weights are channels-last.
+    """
+    def __init__(self, model):
+        super(ChannelsLast, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+def compile_model(model, arch_name, input_shape, cache_dir='./compiled_models', device='cpu'):
+    """
+    Traced and frozen (conv + BN folded) channels-last copy of an eval-mode classifier, model itself is left
+    unchanged. The compiled module is cached on disk per architecture, weights and input shape, later runs load
+    it instead of tracing again. It still backpropagates to its input.
+    :param arch_name: cache key of the architecture, e.g. 'resnet50_imagenet'
+    :param input_shape: C x H x W of the inputs
+    :return: torch.jit.ScriptModule on device
+    """
+    check_versions('The jit backend', '1.8')
+    if isinstance(model, torch.nn.DataParallel):
+        model = model.module
+    path = os.path.join(cache_dir, '{}_{}_{}_{}_torch{}.pt'.format(arch_name, weights_hash(model),
+                                                                    'x'.join(str(v) for v in input_shape),
+                                                                    device, torch.__version__))
+    if os.path.exists(path):
+        return torch.jit.load(path, map_location=device)
+
+    model = ChannelsLast(copy.deepcopy(model).to(device).eval().to(memory_format=torch.channels_last)).eval()
+    with torch.no_grad():
+        compiled = torch.jit.freeze(torch.jit.trace(model, torch.zeros((1,) + tuple(input_shape), device=device)))
+
+    mkdir_p(cache_dir)
+    torch.jit.save(compiled, path)
+    return compiled
+
+
+def weights_hash(model):
+    """Short hash of the parameters and buffers of a model, so that cached compiled models follow the checkpoint."""
+    digest = hashlib.md5()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+
+def estimate_forward_memory(model, input_shape):
+    """
+    Estimates the peak activation memory (in bytes) of one sample in an inference forward pass.
+    :param model: classifier in eval mode
+    :param input_shape: C x H x W shape of one input
+    :return: bytes per sample
+    """
+    sizes = []
+
+    def hook(module, inp, out):
+        if isinstance(out, torch.Tensor):
+            sizes.append(out.numel() * out.element_size())
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if len(list(m.children())) == 0]
+    # Quantized models have no parameters and run on the CPU
+    params = list(model.parameters())
+    with torch.no_grad():
+        model(torch.zeros((1,) + tuple(input_shape), device=params[0].device if params else 'cpu'))
+    for h in handles:
+        h.remove()
+
+    # A residual block keeps its input alive next to the activation it reads and the one it writes
+    return 3 * max(sizes) + 4 * int(np.prod(input_shape))
+
+
+def auto_batch_size(model, input_shape, mem_budget, extra_bytes=0, max_batch=None):
+    """
+    Picks the largest batch whose working memory fits into a budget.
+    :param mem_budget: budget in MB for the activations of one batch (model weights excluded)
+    :param extra_bytes: additional bytes per sample, e.g. masks or inpainter buffers
+    :param max_batch: upper bound, e.g. the number of occlusion windows
+    :return: batch size >= 1
+    """
+    sample_bytes = estimate_forward_memory(model, input_shape) + extra_bytes
+    batch_size = max(int(mem_budget * 2 ** 20 // sample_bytes), 1)
+    if max_batch is not None:
+        batch_size = min(batch_size, max_batch)
+    return batch_size
+
+
+def occlusion_to_pixel_map(heatmap, coords, patch_size, size=224):
+    """
+    Spreads the delta of every occlusion window over the pixels it covered and averages by coverage.
+    :param heatmap: one delta per window, any shape with len(coords) entries
+    :param coords: K x 2 (row, col) top-left corners of the windows
+    :param patch_size: side of the square windows
+    :param size: side of the image
+    :return: size x size map, 0 where no window reached
+    """
+    coords = np.asarray(coords)
+    deltas = np.asarray(heatmap, dtype=np.float64).reshape(-1)
+    y0, x0 = coords[:, 0], coords[:, 1]
+    y1, x1 = np.minimum(y0 + patch_size, size), np.minimum(x0 + patch_size, size)
+
+    # Summed-area table: +/- at the corners of every window, then a 2D prefix sum
+    corners = (np.concatenate((y0, y0, y1, y1)), np.concatenate((x0, x1, x0, x1)))
+    signs = np.concatenate((np.ones_like(y0), -np.ones_like(y0), -np.ones_like(y0), np.ones_like(y0)))
+    total = np.zeros((size + 1, size + 1))
+    np.add.at(total, corners, signs * np.tile(deltas, 4))
+    coverage = np.zeros((size + 1, size + 1))
+    np.add.at(coverage, corners, signs)
+    total = total.cumsum(0).cumsum(1)[:size, :size]
+    coverage = coverage.cumsum(0).cumsum(1)[:size, :size]
+
+    pixel_map = np.zeros((size, size), dtype=np.float32)
+    covered = coverage > 0.5
+    pixel_map[covered] = total[covered] / coverage[covered]
+    return pixel_map
+
+
+class IntermediateWriter(object):
+    """
+    Saves intermediate perturbed images from a background thread.
+
+    The compute loop calls select() to learn which steps are sampled and submit() for those. submit() only
+    clones the tensors and enqueues them; the copy to the host, unnormalization, labelling and JPEG encoding
+    happen on the writer thread. Images are dropped when the queue is full, so the compute loop never waits.
+    """
+    def __init__(self, path, label_map, policy='reservoir:20', digits=5, max_queue=32, seed=0):
+        """
+        :param path: directory of the intermediate_*.jpg files
+        :param policy: 'every:k' (every k-th step), 'reservoir:N' (uniform sample of N steps) or 'off'
+        :param digits: zero padding of the step index in the file names
+        """
+        self.path = path
+        self.label_map = label_map
+        self.digits = digits
+        self.mode, _, value = policy.partition(':')
+        if self.mode not in ('every', 'reservoir', 'off'):
+            raise ValueError('Unknown intermediate image policy: {}'.format(policy))
+        self.k = int(value) if self.mode != 'off' else 0
+
+        # Reservoir sampling keeps the sampled images until close()
+        self.random = random.Random(seed)
+        self.seen = 0
+        self.reservoir = {}
+        self.pending = {}
+
+        self.written = 0
+        self.dropped = 0
+        if self.mode != 'off':
+            mkdir_p(path)
+            self.queue = queue.Queue(maxsize=max_queue)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def select(self, start, count=1):
+        """
+        :param start: step index of the first of count consecutive steps
+        :return: offsets (in [0, count)) of the steps to submit
+        """
+        if self.mode == 'every':
+            return [j for j in range(count) if (start + j) % self.k == 0]
+        if self.mode == 'off':
+            return []
+
+        selected = []
+        for j in range(count):
+            self.seen += 1
+            if len(self.reservoir) + len(self.pending) < self.k:
+                slot = len(self.reservoir) + len(self.pending)
+            else:
+                slot = self.random.randrange(self.seen)
+                if slot >= self.k:
+                    continue
+            self.pending[start + j] = slot
+            selected.append(j)
+        return selected
+
+    def submit(self, index, image, probs, gt_category):
+        """
+        :param index: step index, used in the file name
+        :param image: 3 x H x W normalized tensor, or H x W x 3 uint8 RGB array
+        :param probs: class probabilities of the image
+        :param gt_category: class shown next to the predicted one
+        """
+        if torch.is_tensor(image):
+            image = image.detach().clone()
+        if torch.is_tensor(probs):
+            probs = probs.detach().clone()
+        item = (index, image, probs, gt_category)
+
+        if self.mode == 'reservoir':
+            self.reservoir[self.pending.pop(index)] = item
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Writes the reservoir and waits for the queue to drain."""
+        if self.mode == 'off':
+            return
+        for slot in sorted(self.reservoir):
+            self.queue.put(self.reservoir[slot])
+        self.reservoir = {}
+        self.queue.put(None)
+        self.thread.join()
+
+    def report(self):
+        return 'Intermediate images: {} written, {} dropped'.format(self.written, self.dropped)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._write(*item)
+            self.written += 1
+
+    def _write(self, index, image, probs, gt_category):
+        if torch.is_tensor(image):
+            image = np.uint8(255 * unnormalize(np.moveaxis(image.cpu().numpy().transpose(), 0, 1)))
+        probs = probs.float().cpu().numpy() if torch.is_tensor(probs) else np.asarray(probs)
+        aind = int(probs.argmax())
+        cv2.imwrite(
+            os.path.abspath(os.path.join(self.path, 'intermediate_{:0{}d}_{}_{:.3f}_{}_{:.3f}.jpg'
+                                         .format(index, self.digits, self._short_label(aind), probs[aind],
+                                                 self._short_label(gt_category), probs[gt_category]))),
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+
+    def _short_label(self, category):
+        return self.label_map[category].split(',')[0].split(' ')[0].split('-')[0]
+
+
+def get_blurred_img(img, radius=10):
+    img = Image.fromarray(np.uint8(img))
+    blurred_img = img.filter(ImageFilter.GaussianBlur(radius))
+    return np.array(blurred_img) / float(255)
+
+
 def preprocess_image(img, size):
     transform = transforms.Compose([
         transforms.ToPILImage(),
@@ -1,46 +1,35 @@
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import time
-import ipdb
 import numpy as np
 import tensorflow as tf
-import torch
 from inpaint_model import InpaintCAModel
-from torch.autograd import Variable
+from inpainter_base import InpainterBase
+from inpaint_model_torch import checkpoint_id
 
 
-class CAInpainter(object):
-    def __init__(self, batch_size, checkpoint_dir):
+class CAInpainter(InpainterBase):
+    def __init__(self, batch_size, checkpoint_dir, roi_context=0, cache=None, frozen=False):
+        '''
+        :param roi_context: if > 0, generate_background only inpaints a crop around each hole with this many
+                            pixels (at 256 x 256) of context on each side, see generate_background_roi
+        :param cache: optional InpaintCache looked up before running the network
+        :param frozen: run frozen inference graphs (variables folded into constants), exported next to the
+                       checkpoint as frozen_{side}x{bucket}_{checkpoint}_{mtime}.pb on first use and imported
+                       directly afterwards, a new checkpoint in the directory gets new files
+        '''
+        self.checkpoint_id = checkpoint_id(checkpoint_dir)
+        super(CAInpainter, self).__init__(batch_size, roi_context=roi_context, cache=cache,
+                                          cache_tag='tf_' + self.checkpoint_id)
         self.model = InpaintCAModel()
-        self.images_ph = tf.placeholder(tf.float32,
-                                        shape=[batch_size, 256, 512, 3])
-
-        # with tf.device('/gpu:0'):
-        # with tf.device('/cpu:0'):
-        # for i, d in enumerate(['/gpu:0', '/gpu:1', '/gpu:2', '/gpu:3']):
-        #     with tf.device(d):
-        output = self.model.build_server_graph(self.images_ph)
-        output = (output + 1.) * 127.5
-        output = tf.reverse(output, [-1])
-        output = tf.saturate_cast(output, tf.uint8)
-        self.output = output
-
-        # load pretrained model
-        vars_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
-        self.assign_ops = []
-        for var in vars_list:
-            vname = var.name
-            from_name = vname
-            var_value = tf.contrib.framework.load_variable(checkpoint_dir, from_name)
-            self.assign_ops.append(tf.assign(var, var_value))
-        # print('Model loaded.')
-
-        self.pth_mean = np.ones((1, 3, 1, 1), dtype='float32')
-        self.pth_mean[0, :, 0, 0] = np.array([0.485, 0.456, 0.406])
-        self.pth_std = np.ones((1, 3, 1, 1), dtype='float32')
-        self.pth_std[0, :, 0, 0] = np.array([0.229, 0.224, 0.225])
-        self.upsample = torch.nn.Upsample(size=(256, 256), mode='bilinear')
-        self.downsample = torch.nn.Upsample(size=(224, 224), mode='bilinear')
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+        self.frozen = frozen
+        self.saver = None
+        # The contextual attention needs a static batch size, so inputs are padded to the next power of two
+        # (or batch_size) and every (side, bucket) gets its own graph sharing the variables of the first one
+        self.buckets = [2 ** k for k in range(int(np.ceil(np.log2(batch_size))))] + [batch_size]
+        self.graphs = {}
 
         # Create a session
         sess_config = tf.ConfigProto()
@@ -49,82 +38,87 @@ class CAInpainter(object):
         # sess_config.log_device_placement = True
         self.sess = tf.Session(config=sess_config)
 
-        self.sess.run(self.assign_ops)
-
-    def impute_missing_imgs(self, pytorch_image, pytorch_mask):
+        # with tf.device('/gpu:0'):
+        # with tf.device('/cpu:0'):
+        # for i, d in enumerate(['/gpu:0', '/gpu:1', '/gpu:2', '/gpu:3']):
+        #     with tf.device(d):
+        self.images_ph, self.output = self.graph(256, batch_size)
+
+    def run_network(self, input_image):
+        # Chunks of at most batch_size, each padded to its bucket
+        outputs = []
+        for k in range(0, len(input_image), self.batch_size):
+            chunk = input_image[k:k + self.batch_size]
+            bucket = min(b for b in self.buckets if b >= len(chunk))
+            padded = np.zeros((bucket,) + chunk.shape[1:])
+            padded[:len(chunk)] = chunk
+            images_ph, output = self.graph(chunk.shape[1], bucket)
+            outputs.append(self.sess.run(output, {images_ph: padded})[:len(chunk)])
+        return np.concatenate(outputs)
+
+    def graph(self, side, bucket):
         '''
-        :param pytorch_image: 1 x 3 x 224 x 224
-        :param pytorch_mask: 1 x 3 x 224 x 224. Mask
-        :return:
+        Inference graph for bucket side x side images, built on first use. All graphs share the variables, so
+        no weights are loaded again. With frozen, a cached frozen graph is imported instead when it exists.
         '''
-        pth_img = self.generate_background(pytorch_image, pytorch_mask)
+        if (side, bucket) not in self.graphs:
+            start = time.time()
+            path = os.path.join(self.checkpoint_dir, 'frozen_{}x{}_{}.pb'.format(side, bucket, self.checkpoint_id))
+            if self.frozen and os.path.exists(path):
+                self.graphs[side, bucket] = self.import_frozen(path, side, bucket)
+                how = 'imported from ' + path
+            else:
+                self.graphs[side, bucket] = self.build_graph(side, bucket)
+                how = 'built'
+                if self.frozen:
+                    self.export_frozen(path, side, bucket)
+                    how = 'built and frozen'
+            print('CAInpainter: {} x {}x{} graph {} in {:.2f}s'.format(bucket, side, side, how, time.time() - start))
+        return self.graphs[side, bucket]
+
+    def build_graph(self, side, bucket):
+        images_ph = tf.placeholder(tf.float32, shape=[bucket, side, 2 * side, 3],
+                                   name='images_{}x{}'.format(side, bucket))
+        output = self.model.build_server_graph(images_ph, reuse=self.saver is not None)
+        output = (output + 1.) * 127.5
+        output = tf.reverse(output, [-1])
+        output = tf.saturate_cast(output, tf.uint8)
+        output = tf.identity(output, name='output_{}x{}'.format(side, bucket))
 
-        return pytorch_image * pytorch_mask + pth_img * (1. - pytorch_mask)
+        # load pretrained model, all variables in a single restore op
+        if self.saver is None:
+            start = time.time()
+            self.saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES))
+            self.saver.restore(self.sess, self.checkpoint)
+            print('CAInpainter: checkpoint restored in {:.2f}s'.format(time.time() - start))
+        return images_ph, output
 
-    def generate_background(self, pytorch_image, pytorch_mask, batch_process=False):
+    def export_frozen(self, path, side, bucket):
         '''
-        Use to generate whole blurry images with pytorch normalization.
+        Writes the inference-only GraphDef of a built graph: variables become constants, ops the output does
+        not need are stripped and constant subgraphs are folded.
         '''
-
-        mask = pytorch_mask.expand(pytorch_mask.shape[0], 3, 224, 224)
-        mask = self.upsample(Variable(mask)).data  # .round()
-        mask = mask.cpu().numpy()
-        thresh = max(0.5, 0.5 * (np.max(mask) + np.min(mask)))
-        mask = (mask < thresh).astype(float)
-
-        # Make it into tensorflow input ordering, then resizing then normalization
-        # Do 3 things:
-        # - Move from NCHW to NHWC, and from RGB to BGR input
-        # - Normalize to 0 - 255 with integer round up
-        # - Resize the image size to be 256 x 256
-        mask = np.moveaxis(mask, 1, -1)*255
-        # mask = (1. - mask) * 255
-
-        image = self.upsample(Variable(pytorch_image)).data.cpu().numpy()
-        image = np.round((image * self.pth_std + self.pth_mean) * 255)
-        image = np.moveaxis(image, 1, -1)
-        image = image[:, :, :, ::-1]
-
-        # t1 = time.time()
-        if batch_process:
-            image = np.stack((image[0, :], )*mask.shape[0], axis=0)
-
-        input_image = np.concatenate([image, mask], axis=2)
-        # print(time.time() - t1)
-
-        # DEBUG
-        # import cv2
-        # cv2.imwrite('./test_input.jpg', input_image[0])
-
-        # t1 = time.time()
-        tf_images = self.sess.run(self.output, {self.images_ph: input_image})
-        # print(time.time() - t1)
-        # print('#'*25)
-
-        # it's RGB back. So just change back to pytorch normalization
-        pth_img = np.moveaxis(tf_images, 3, 1)
-        pth_img = ((pth_img / 255.) - self.pth_mean) / self.pth_std
-
-        pth_img = pytorch_image.new(pth_img)
-        pth_img = self.downsample(Variable(pth_img)).data
-
-        return pth_img, mask
-
-    def time_impute_missing_imgs(self, pytorch_image, pytorch_mask):
-        start_time = time.time()
-        result = self.impute_missing_imgs(pytorch_image, pytorch_mask)
-        print('Total time:', time.time() - start_time)
-        return result
-
-    def reset(self):
-        pass
-
-    def eval(self):
-        pass
-
-    def cuda(self):
-        self.upsample.cuda()
-        self.downsample.cuda()
+        from tensorflow.tools.graph_transforms import TransformGraph
+
+        input_name, output_name = 'images_{}x{}'.format(side, bucket), 'output_{}x{}'.format(side, bucket)
+        graph_def = tf.graph_util.convert_variables_to_constants(self.sess, self.sess.graph.as_graph_def(),
+                                                                 [output_name])
+        graph_def = TransformGraph(graph_def, [input_name], [output_name],
+                                   ['strip_unused_nodes', 'fold_constants(ignore_errors=true)'])
+        try:
+            with tf.gfile.GFile(path, 'wb') as f:
+                f.write(graph_def.SerializeToString())
+        except (IOError, OSError, tf.errors.OpError):
+            # Read-only checkpoint directory
+            print('CAInpainter: cannot write {}'.format(path))
+
+    def import_frozen(self, path, side, bucket):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        return tf.import_graph_def(graph_def, name='frozen_{}x{}'.format(side, bucket),
+                                   return_elements=['images_{}x{}:0'.format(side, bucket),
+                                                    'output_{}x{}:0'.format(side, bucket)])
 
     def __del__(self):
         self.sess.close()
@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+from inpaint_model_torch import checkpoint_id, load_inpaint_net
+from inpainter_base import InpainterBase
+
+
+class CAInpainter2(InpainterBase):
+    '''
+    CAInpainter with the pytorch port of the network (see inpaint_model_torch), loading the same tensorflow
+    checkpoints. Without a cache and crop inpainting, generate_background stays on the device of its inputs.
+    '''
+    def __init__(self, batch_size, checkpoint_dir, roi_context=0, cache=None, device=None):
+        '''
+        :param batch_size: largest number of images per network call, any batch size is accepted
+        :param device: device of the network, None = cuda if available
+        '''
+        super(CAInpainter2, self).__init__(batch_size, roi_context=roi_context, cache=cache,
+                                           cache_tag='torch_' + checkpoint_id(checkpoint_dir))
+        self.device = device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.net = load_inpaint_net(checkpoint_dir).to(self.device)
+        for p in self.net.parameters():
+            p.requires_grad = False
+
+    def complete(self, images, masks):
+        '''
+        :param images: N x 3 x H x W BGR images (0 - 255)
+        :param masks: N x 1 x H x W, 1 in the hole
+        :return: N x 3 x H x W RGB uint8 completed images, rounded like the saturate_cast of the tensorflow graph
+        '''
+        outputs = []
+        with torch.no_grad():
+            for k in range(0, len(images), self.batch_size):
+                output = self.net.complete(images[k:k + self.batch_size], masks[k:k + self.batch_size])
+                outputs.append(torch.clamp((output.flip(1) + 1.) * 127.5, 0, 255).to(torch.uint8))
+        return torch.cat(outputs)
+
+    def run_network(self, input_image):
+        images = torch.from_numpy(np.float32(input_image)).to(self.device).permute(0, 3, 1, 2)
+        side = images.shape[3] // 2
+        output = self.complete(images[:, :, :, :side], (images[:, :1, :, side:] > 127.5).float())
+        return output.permute(0, 2, 3, 1).cpu().numpy()
+
+    def generate_background(self, pytorch_image, pytorch_mask, batch_process=False):
+        '''
+        Same as CAInpainter.generate_background, the returned mask is N x 1 x 256 x 256 (1 in the hole) when the
+        conversions run on the device.
+        '''
+        if self.cache is not None or self.roi_context > 0:
+            return super(CAInpainter2, self).generate_background(pytorch_image, pytorch_mask, batch_process)
+
+        # to_tf_inputs: every mask is thresholded on its own range
+        mask = self.upsample(pytorch_mask.expand(pytorch_mask.shape[0], 3, 224, 224).to(self.device))[:, :1]
+        flat_mask = mask.reshape(len(mask), -1)
+        thresh = torch.clamp(0.5 * (flat_mask.max(1)[0] + flat_mask.min(1)[0]), min=0.5)
+        mask = (mask < thresh.view(-1, 1, 1, 1)).float()
+
+        mean = torch.from_numpy(self.pth_mean).to(self.device)
+        std = torch.from_numpy(self.pth_std).to(self.device)
+        image = self.upsample(pytorch_image.to(self.device))
+        image = torch.round((image * std + mean) * 255).flip(1)
+        if batch_process:
+            image = image[:1].expand(len(mask), -1, -1, -1)
+
+        # to_pytorch
+        output = ((self.complete(image, mask).float() / 255.) - mean) / std
+        return self.downsample(output).to(pytorch_image.device), mask
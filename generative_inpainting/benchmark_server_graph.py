@@ -0,0 +1,75 @@
+import os
+import cv2
+import glob
+import time
+import argparse
+import numpy as np
+
+# Latency of the inference-only server graph against the full graph (with the offset flow visualization) on the CPU
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint_dir', default='model_logs/release_imagenet_256', type=str,
+                    help='tensorflow checkpoint of the inpainter')
+parser.add_argument('--mask', default='examples/center_mask_256.png', type=str,
+                    help='mask of every image, value 255 indicates mask')
+parser.add_argument('--batch_sizes', default='1,4,8', type=str,
+                    help='comma separated batch sizes')
+parser.add_argument('--num_iters', default=5, type=int,
+                    help='timed network calls per batch size')
+parser.add_argument('--num_threads', default='0', type=str,
+                    help='comma separated tensorflow intra-op thread counts, 0 = default')
+
+
+def server_graph(batch_size, inference, checkpoint_dir, num_threads):
+    '''
+    :return: session, input placeholder, output and seconds spent on building the graph and restoring
+    '''
+    start = time.time()
+    graph = tf.Graph()
+    with graph.as_default():
+        images_ph = tf.placeholder(tf.float32, shape=[batch_size, 256, 512, 3])
+        output = InpaintCAModel().build_server_graph(images_ph, inference=inference)
+        output = tf.saturate_cast(tf.reverse((output + 1.) * 127.5, [-1]), tf.uint8)
+        saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES))
+    sess = tf.Session(graph=graph, config=tf.ConfigProto(intra_op_parallelism_threads=num_threads))
+    saver.restore(sess, tf.train.latest_checkpoint(checkpoint_dir))
+    return sess, images_ph, output, time.time() - start
+
+
+def seconds_per_batch(sess, images_ph, output, input_image, num_iters):
+    # Warm up
+    sess.run(output, {images_ph: input_image})
+    start = time.time()
+    for _ in range(num_iters):
+        result = sess.run(output, {images_ph: input_image})
+    return (time.time() - start) / num_iters, result
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    import tensorflow as tf
+    from inpaint_model import InpaintCAModel
+
+    mask = cv2.imread(args.mask)
+    images = [cv2.imread(path) for path in sorted(glob.glob(os.path.join('examples', 'imagenet', '*_input.png')))]
+
+    print('threads | batch | graph | ops | build + restore s | s / batch | images / s')
+    for num_threads in [int(t) for t in args.num_threads.split(',')]:
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            input_image = np.stack([np.concatenate([images[k % len(images)], mask], axis=1)
+                                    for k in range(batch_size)]).astype(np.float32)
+            latencies, outputs = [], []
+            for inference in [False, True]:
+                sess, images_ph, output, build_time = server_graph(batch_size, inference, args.checkpoint_dir,
+                                                                   num_threads)
+                latency, result = seconds_per_batch(sess, images_ph, output, input_image, args.num_iters)
+                print('{} | {} | {} | {} | {:.2f} | {:.3f} | {:.2f}'.format(
+                    num_threads, batch_size, 'inference' if inference else 'full',
+                    len(sess.graph.get_operations()), build_time, latency, batch_size / latency))
+                latencies.append(latency)
+                outputs.append(result)
+                sess.close()
+            print('{} | {} | saved {:.3f}s per batch ({:.1f}%), outputs identical: {}'.format(
+                num_threads, batch_size, latencies[0] - latencies[1],
+                100. * (latencies[0] - latencies[1]) / latencies[0], np.array_equal(outputs[0], outputs[1])))
@@ -0,0 +1,44 @@
+import os
+import cv2
+import glob
+import time
+import argparse
+import numpy as np
+import torch
+from CAInpainter2 import CAInpainter2
+
+# Images / sec of the pytorch port of the CA-inpainter on the CPU over batch sizes and threads
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint_dir', default='model_logs/release_imagenet_256', type=str,
+                    help='tensorflow checkpoint of the inpainter')
+parser.add_argument('--mask', default='examples/center_mask_256.png', type=str,
+                    help='mask of every image, value 255 indicates mask')
+parser.add_argument('--batch_sizes', default='1,4,8', type=str,
+                    help='comma separated batch sizes')
+parser.add_argument('--num_iters', default=3, type=int,
+                    help='timed network calls per batch size')
+parser.add_argument('--num_threads', default='0', type=str,
+                    help='comma separated torch intra-op thread counts, 0 = default')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    mask = cv2.imread(args.mask)
+    images = [cv2.imread(path) for path in sorted(glob.glob(os.path.join('examples', 'imagenet', '*_input.png')))]
+    default_threads = torch.get_num_threads()
+    inpainter = CAInpainter2(max(int(b) for b in args.batch_sizes.split(',')), args.checkpoint_dir, device='cpu')
+
+    print('threads | batch | s / batch | images / s')
+    for num_threads in [int(t) for t in args.num_threads.split(',')]:
+        torch.set_num_threads(num_threads or default_threads)
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            input_image = np.stack([np.concatenate([images[k % len(images)], mask], axis=1)
+                                    for k in range(batch_size)]).astype(np.float32)
+            # Warm up
+            inpainter.run_network(input_image)
+            start = time.time()
+            for _ in range(args.num_iters):
+                inpainter.run_network(input_image)
+            latency = (time.time() - start) / args.num_iters
+            print('{} | {} | {:.3f} | {:.2f}'.format(torch.get_num_threads(), batch_size, latency,
+                                                     batch_size / latency))
@@ -0,0 +1,68 @@
+import os
+import cv2
+import glob
+import time
+import argparse
+import numpy as np
+from CAInpainter2 import CAInpainter2
+
+# Compares the pytorch port of the CA-inpainter with the tensorflow graph on the bundled examples
+parser = argparse.ArgumentParser()
+parser.add_argument('--dataset', default='imagenet', type=str,
+                    help='bundled examples and checkpoint to compare on: imagenet | celeba')
+parser.add_argument('--checkpoint_dir', default='', type=str,
+                    help='tensorflow checkpoint, empty = model_logs/release_{dataset}_256')
+parser.add_argument('--mask', default='examples/center_mask_256.png', type=str,
+                    help='mask of every example, value 255 indicates mask')
+parser.add_argument('--tol', default=2., type=float,
+                    help='largest mean absolute difference (0 - 255) inside the holes')
+parser.add_argument('--frozen', default=0, type=int,
+                    help='run the tensorflow inpainter from its cached frozen graph (exported on the first run)')
+
+
+def network_inputs(paths, mask_path):
+    mask = cv2.imread(mask_path)
+    images = [cv2.imread(path) for path in paths]
+    return np.stack([np.concatenate([image, mask], axis=1) for image in images]).astype(np.float32), \
+        mask[:, :, 0] > 127.5
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    checkpoint_dir = args.checkpoint_dir or os.path.join('model_logs', 'release_{}_256'.format(args.dataset))
+    paths = sorted(glob.glob(os.path.join('examples', args.dataset, '*_input.png')))
+    input_image, hole = network_inputs(paths, args.mask)
+
+    start = time.time()
+    torch_inpainter = CAInpainter2(len(paths), checkpoint_dir)
+    print('pytorch: loaded in {:.2f}s'.format(time.time() - start))
+    start = time.time()
+    torch_output = torch_inpainter.run_network(input_image)
+    print('pytorch: {} images in {:.2f}s'.format(len(paths), time.time() - start))
+
+    try:
+        from CAInpainter import CAInpainter
+    except ImportError:
+        # Without tensorflow, test.py's output of the first imagenet example (examples/output.png, BGR) is
+        # the reference
+        print('tensorflow is not available, comparing with examples/output.png')
+        reference = cv2.imread('examples/output.png')[:, :, ::-1][None]
+        torch_output = torch_output[[p.endswith('val_00000827_input.png') for p in paths]]
+        names = ['output.png']
+    else:
+        start = time.time()
+        tf_inpainter = CAInpainter(len(paths), checkpoint_dir, frozen=args.frozen)
+        print('tensorflow: loaded in {:.2f}s'.format(time.time() - start))
+        start = time.time()
+        reference = tf_inpainter.run_network(input_image)
+        print('tensorflow: {} images in {:.2f}s'.format(len(paths), time.time() - start))
+        names = [os.path.basename(p) for p in paths]
+
+    worst = 0.
+    for name, output, ref in zip(names, torch_output, reference):
+        diff = np.abs(output.astype(float) - ref.astype(float))
+        worst = max(worst, diff[hole].mean())
+        print('{}: hole mean {:.3f}, hole max {:.0f}, outside max {:.0f}'.format(
+            name, diff[hole].mean(), diff[hole].max(), diff[~hole].max()))
+    print('{} (worst hole mean {:.3f}, tolerance {})'.format('OK' if worst <= args.tol else 'MISMATCH', worst,
+                                                            args.tol))
@@ -0,0 +1,110 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class InpaintCache(object):
+    '''
+    Content addressed cache of inpainted images (uint8 network outputs).
+
+    Entries are kept in an in-memory LRU and, if cache_dir is given, in compressed .npz files on disk.
+    The disk tier is capped at max_disk_mb, the least recently used files are evicted first.
+    '''
+    def __init__(self, cache_dir=None, max_memory_items=256, max_disk_mb=2048):
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_mb * 2 ** 20
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.disk = OrderedDict()
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            files = [f for f in os.listdir(cache_dir) if f.endswith('.npz') and not f.endswith('.tmp.npz')]
+            files.sort(key=lambda f: os.path.getmtime(os.path.join(cache_dir, f)))
+            for f in files:
+                self.disk[f[:-4]] = os.path.getsize(os.path.join(cache_dir, f))
+        self.disk_bytes = sum(self.disk.values())
+
+    @staticmethod
+    def image_key(image):
+        return hashlib.sha1(np.ascontiguousarray(image, dtype=np.float32).tobytes()).hexdigest()
+
+    @staticmethod
+    def key(image_key, mask, context=0, inpainter=''):
+        '''
+        :param image_key: image_key of the network input image
+        :param mask: H x W (x C) network input mask, binarized at its mid value
+        :param context: inpainting variant, e.g. the ROI context
+        :param inpainter: implementation and checkpoint of the network, see InpainterBase.cache_tag
+        '''
+        mask = np.asarray(mask)
+        if mask.ndim == 3:
+            mask = mask[:, :, 0]
+        digest = hashlib.sha1(np.packbits(mask > 127.5).tobytes())
+        digest.update('{}_{}_{}_{}'.format(image_key, mask.shape, context, inpainter).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if key in self.disk:
+            path = self._path(key)
+            try:
+                with np.load(path) as f:
+                    value = f['image']
+            except (IOError, OSError, ValueError, KeyError):
+                # Unreadable entry, e.g. a partially written file
+                self._evict_disk(key)
+            else:
+                os.utime(path, None)
+                self.disk.move_to_end(key)
+                self._put_memory(key, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = np.asarray(value, dtype=np.uint8)
+        self._put_memory(key, value)
+        if self.cache_dir is None or key in self.disk:
+            return
+
+        path = self._path(key)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, image=value)
+        os.rename(tmp_path, path)
+        self.disk[key] = os.path.getsize(path)
+        self.disk_bytes += self.disk[key]
+        while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+            self._evict_disk(next(iter(self.disk)))
+
+    def report(self):
+        total = self.hits + self.misses
+        return 'Inpainting cache: {} hits, {} misses ({:.1f}% hit rate), {} files ({:.1f} MB) on disk'.format(
+            self.hits, self.misses, 100. * self.hits / max(total, 1), len(self.disk), self.disk_bytes / 2. ** 20)
+
+    def _put_memory(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self, key):
+        self.disk_bytes -= self.disk.pop(key)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
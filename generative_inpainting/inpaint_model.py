@@ -21,12 +21,15 @@ class InpaintCAModel(Model):
         super().__init__('InpaintCAModel')
 
     def build_inpaint_net(self, x, mask, config=None, reuse=False,
-                          training=True, padding='SAME', name='inpaint_net'):
+                          training=True, padding='SAME', name='inpaint_net',
+                          inference=False):
         """Inpaint network.
 
         Args:
             x: incomplete image, [-1, 1]
             mask: mask region {0, 1}
+            inference: only build the ops of the stage 2 output, the offset
+                flow visualization is not built and returned as None
         Returns:
             [-1, 1] as predicted image
         """
@@ -88,7 +91,8 @@ class InpaintCAModel(Model):
             x = gen_conv(x, 4*cnum, 3, 1, name='pmconv5')
             x = gen_conv(x, 4*cnum, 3, 1, name='pmconv6',
                          activation=tf.nn.relu)
-            x, offset_flow = contextual_attention(x, x, mask_s, 3, 1, rate=2)
+            x, offset_flow = contextual_attention(x, x, mask_s, 3, 1, rate=2,
+                                                  return_flow=not inference)
             x = gen_conv(x, 4*cnum, 3, 1, name='pmconv9')
             x = gen_conv(x, 4*cnum, 3, 1, name='pmconv10')
             pm = x
@@ -287,8 +291,12 @@ class InpaintCAModel(Model):
                 tf.constant(config.HEIGHT), tf.constant(config.WIDTH))
         return self.build_infer_graph(batch_data, config, bbox, name)
 
-    def build_server_graph(self, batch_data, reuse=False, is_training=False):
+    def build_server_graph(self, batch_data, reuse=False, is_training=False,
+                           inference=True):
         """
+        Args:
+            inference: skip the ops the completed image does not need, see
+                build_inpaint_net
         """
         # generate mask, 1 represents masked point
         batch_raw, masks_raw = tf.split(batch_data, 2, axis=2)
@@ -300,7 +308,7 @@ class InpaintCAModel(Model):
         # inpaint
         x1, x2, flow = self.build_inpaint_net(
             batch_incomplete, masks, reuse=reuse, training=is_training,
-            config=None)
+            config=None, inference=inference)
 
         batch_predict = x2
         # apply mask and reconstruct
@@ -0,0 +1,398 @@
+""" PyTorch port of the inference network of InpaintCAModel """
+
+import os
+import struct
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _varint(buf, pos):
+    result, shift = 0, 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _proto_fields(buf):
+    """Fields of a serialized protobuf message as (field number, value), values of length-delimited fields as bytes."""
+    pos, fields = 0, []
+    while pos < len(buf):
+        tag, pos = _varint(buf, pos)
+        wire_type = tag & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        elif wire_type == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+        fields.append((tag >> 3, value))
+    return fields
+
+
+def _table_block(buf, offset, size):
+    """Key/value entries of an uncompressed block of the checkpoint index (a LevelDB table)."""
+    block = buf[offset:offset + size]
+    num_restarts = struct.unpack('<I', block[-4:])[0]
+    end = len(block) - 4 - 4 * num_restarts
+    pos, key, entries = 0, b'', []
+    while pos < end:
+        shared, pos = _varint(block, pos)
+        non_shared, pos = _varint(block, pos)
+        value_length, pos = _varint(block, pos)
+        key = key[:shared] + block[pos:pos + non_shared]
+        pos += non_shared
+        entries.append((key, block[pos:pos + value_length]))
+        pos += value_length
+    return entries
+
+
+# BundleEntryProto dtypes of the checkpoints
+_DTYPES = {1: np.float32, 2: np.float64, 3: np.int32, 9: np.int64}
+
+
+def checkpoint_prefix(checkpoint_dir):
+    """Path prefix of the latest checkpoint listed in the 'checkpoint' file of a directory."""
+    with open(os.path.join(checkpoint_dir, 'checkpoint')) as f:
+        prefix = f.readline().split(':', 1)[1].strip().strip('"')
+    return os.path.join(checkpoint_dir, prefix)
+
+
+def checkpoint_id(checkpoint_dir):
+    """
+    Identifies the weights of a checkpoint directory for files derived from them: a new or overwritten
+    checkpoint gets a new id.
+    :return: '{checkpoint name}_{mtime of its index}', e.g. 'snap-0_1695783600'
+    """
+    prefix = checkpoint_prefix(checkpoint_dir)
+    return '{}_{}'.format(os.path.basename(prefix), int(os.path.getmtime(prefix + '.index')))
+
+
+def read_tf_checkpoint(checkpoint_dir):
+    """
+    Reads the variables of a TF checkpoint (V2 format) without tensorflow.
+    :param checkpoint_dir: directory with a 'checkpoint' file, e.g. model_logs/release_imagenet_256
+    :return: dict of variable name -> numpy array
+    """
+    prefix = checkpoint_prefix(checkpoint_dir)
+
+    with open(prefix + '.index', 'rb') as f:
+        index = f.read()
+    footer = index[-48:]
+    if struct.unpack('<Q', footer[-8:])[0] != 0xdb4775248b80fb57:
+        raise ValueError('{}.index is not a checkpoint index'.format(prefix))
+    _, pos = _varint(footer, 0)
+    _, pos = _varint(footer, pos)
+    index_offset, pos = _varint(footer, pos)
+    index_size, pos = _varint(footer, pos)
+
+    entries = []
+    for _, handle in _table_block(index, index_offset, index_size):
+        offset, pos = _varint(handle, 0)
+        size, _ = _varint(handle, pos)
+        entries.extend(_table_block(index, offset, size))
+
+    variables, shards = {}, {}
+    for key, value in entries:
+        if not key:
+            # Bundle header
+            continue
+        fields = dict(_proto_fields(value))
+        if fields.get(1, 1) not in _DTYPES or 7 in fields:
+            raise ValueError('Unsupported checkpoint entry {}'.format(key.decode()))
+        shape = [dict(_proto_fields(dim)).get(1, 0) for number, dim in _proto_fields(fields.get(2, b''))
+                 if number == 2]
+        shard = fields.get(3, 0)
+        if shard not in shards:
+            with open('{}.data-{:05d}-of-{:05d}'.format(prefix, shard, _num_shards(prefix)), 'rb') as f:
+                shards[shard] = f.read()
+        dtype = _DTYPES[fields.get(1, 1)]
+        offset, size = fields.get(4, 0), fields.get(5, 0)
+        variables[key.decode()] = np.frombuffer(shards[shard], dtype=dtype, count=size // np.dtype(dtype).itemsize,
+                                                offset=offset).reshape(shape).copy()
+    return variables
+
+
+def _num_shards(prefix):
+    directory, name = os.path.split(prefix)
+    return sum(1 for f in os.listdir(directory) if f.startswith(name + '.data-'))
+
+
+def resize_nearest(x, size):
+    """
+    tf.image.resize_nearest_neighbor with align_corners=True (TF1), as used by neuralgym's resize.
+    :param x: N x C x H x W
+    :param size: output height and width
+    """
+    indices = []
+    for n_in, n_out in zip(x.shape[2:], size):
+        scale = np.float32((n_in - 1) / np.float32(n_out - 1)) if n_out > 1 else np.float32(n_in / np.float32(n_out))
+        pos = np.arange(n_out, dtype=np.float32) * scale
+        # roundf, half away from zero
+        index = np.floor(pos)
+        index += (pos - index) >= 0.5
+        indices.append(torch.from_numpy(np.minimum(index, n_in - 1).astype(np.int64)).to(x.device))
+    return x[:, :, indices[0]][:, :, :, indices[1]]
+
+
+def same_padding(n_in, ksize, stride=1, rate=1):
+    """Top (left) and total padding of a tensorflow 'SAME' convolution."""
+    k_eff = (ksize - 1) * rate + 1
+    n_out = (n_in + stride - 1) // stride
+    total = max((n_out - 1) * stride + k_eff - n_in, 0)
+    return total // 2, total
+
+
+def pad_same(x, ksize, stride=1, rate=1):
+    top, total_h = same_padding(x.shape[2], ksize, stride, rate)
+    left, total_w = same_padding(x.shape[3], ksize, stride, rate)
+    return F.pad(x, (left, total_w - left, top, total_h - top))
+
+
+class GenConv(nn.Module):
+    """gen_conv: 'SAME' padded (dilated) convolution followed by ELU."""
+    def __init__(self, cin, cnum, ksize, stride=1, rate=1, activation=F.elu):
+        super(GenConv, self).__init__()
+        self.conv = nn.Conv2d(cin, cnum, ksize, stride, dilation=rate)
+        self.activation = activation
+
+    def forward(self, x):
+        conv = self.conv
+        x = conv(pad_same(x, conv.kernel_size[0], conv.stride[0], conv.dilation[0]))
+        return x if self.activation is None else self.activation(x)
+
+
+class GenDeconv(GenConv):
+    """gen_deconv: 2x nearest neighbour upsampling followed by gen_conv."""
+    def __init__(self, cin, cnum):
+        super(GenDeconv, self).__init__(cin, cnum, 3)
+
+    def forward(self, x):
+        return super(GenDeconv, self).forward(resize_nearest(x, (2 * x.shape[2], 2 * x.shape[3])))
+
+
+def fuse_diagonal(y, k):
+    """
+    Convolution of N x P x Q scores with a k x k identity kernel ('SAME' padding), as a sum of k shifted copies.
+    """
+    padded = F.pad(y, (k // 2, k // 2, k // 2, k // 2))
+    return sum(padded[:, d:d + y.shape[1], d:d + y.shape[2]] for d in range(k))
+
+
+def contextual_attention(f, b, mask, ksize=3, stride=1, rate=2, fuse_k=3, softmax_scale=10., fuse=True):
+    """
+    inpaint_ops.contextual_attention for inference, without the offset flow visualization.
+    :param f: N x C x H x W foreground features to match
+    :param b: N x C x H x W background features to match from
+    :param mask: N x 1 x H x W, 1 where background patches are not available
+    :return: N x C x H x W reconstructed foreground
+    """
+    num, channels, height, width = b.shape
+    # Background patches of the original resolution, used for reconstruction
+    kernel = 2 * rate
+    raw_w = F.unfold(pad_same(b, kernel, rate * stride), kernel, stride=rate * stride)
+    raw_w = raw_w.view(num, channels, kernel, kernel, -1).permute(0, 4, 1, 2, 3)
+
+    # Matching on the downscaled foreground and background
+    f = resize_nearest(f, (int(f.shape[2] / rate), int(f.shape[3] / rate)))
+    b = resize_nearest(b, (int(height / rate), int(width / rate)))
+    mask = resize_nearest(mask, (int(mask.shape[2] / rate), int(mask.shape[3] / rate)))
+    fs, bs = f.shape[2:], b.shape[2:]
+    w = F.unfold(pad_same(b, ksize, stride), ksize, stride=stride)
+    w = w.view(num, channels, ksize, ksize, -1).permute(0, 4, 1, 2, 3)
+
+    # Background patches touching the hole are not used
+    m_patches = F.unfold(pad_same(mask, ksize, stride), ksize, stride=stride)
+    mm = (m_patches.mean(dim=1) == 0.).float()
+
+    w_norm = w / torch.clamp(torch.sqrt(torch.sum(w ** 2, dim=(2, 3, 4), keepdim=True)), min=1e-4)
+    # Cosine similarity of every foreground position with every background patch, N x HWf x HWb, the batched
+    # matmul of the foreground patches with the background patches replaces one convolution per sample
+    f_patches = F.unfold(pad_same(f, ksize), ksize)
+    y = torch.bmm(f_patches.transpose(1, 2), w_norm.reshape(num, w_norm.shape[1], -1).transpose(1, 2))
+
+    # Fuse the scores of neighbouring patches to encourage large patches
+    if fuse:
+        y = fuse_diagonal(y, fuse_k)
+        y = y.view(num, fs[0], fs[1], bs[0], bs[1]).permute(0, 2, 1, 4, 3).reshape(num, fs[0] * fs[1], -1)
+        y = fuse_diagonal(y, fuse_k)
+        y = y.view(num, fs[1], fs[0], bs[1], bs[0]).permute(0, 2, 1, 4, 3).reshape(num, fs[0] * fs[1], -1)
+
+    # Softmax to match
+    y = y * mm[:, None]
+    y = F.softmax(y * softmax_scale, dim=2)
+    y = y * mm[:, None]
+    # Most weights underflow, subnormal floats would slow the matmul down by orders of magnitude on the CPU
+    # (tensorflow flushes them to zero)
+    y = y.masked_fill(y < torch.finfo(y.dtype).tiny, 0.)
+
+    # Paste the matched patches, the transpose of a 'SAME' strided convolution: every foreground position
+    # combines the raw background patches, and fold adds up the overlapping patches
+    y = torch.bmm(raw_w.reshape(num, raw_w.shape[1], -1).transpose(1, 2), y.transpose(1, 2))
+    y = F.fold(y, ((fs[0] - 1) * rate + kernel, (fs[1] - 1) * rate + kernel), kernel, stride=rate)
+    top, _ = same_padding(height, kernel, rate)
+    left, _ = same_padding(width, kernel, rate)
+    return y[:, :, top:top + height, left:left + width] / 4.
+
+
+class InpaintCANet(nn.Module):
+    """InpaintCAModel.build_inpaint_net, with the layer names of the tensorflow variable scopes."""
+    def __init__(self, cnum=32):
+        super(InpaintCANet, self).__init__()
+        # stage1
+        self.conv1 = GenConv(5, cnum, 5, 1)
+        self.conv2_downsample = GenConv(cnum, 2 * cnum, 3, 2)
+        self.conv3 = GenConv(2 * cnum, 2 * cnum, 3, 1)
+        self.conv4_downsample = GenConv(2 * cnum, 4 * cnum, 3, 2)
+        self.conv5 = GenConv(4 * cnum, 4 * cnum, 3, 1)
+        self.conv6 = GenConv(4 * cnum, 4 * cnum, 3, 1)
+        self.conv7_atrous = GenConv(4 * cnum, 4 * cnum, 3, rate=2)
+        self.conv8_atrous = GenConv(4 * cnum, 4 * cnum, 3, rate=4)
+        self.conv9_atrous = GenConv(4 * cnum, 4 * cnum, 3, rate=8)
+        self.conv10_atrous = GenConv(4 * cnum, 4 * cnum, 3, rate=16)
+        self.conv11 = GenConv(4 * cnum, 4 * cnum, 3, 1)
+        self.conv12 = GenConv(4 * cnum, 4 * cnum, 3, 1)
+        self.conv13_upsample = GenDeconv(4 * cnum, 2 * cnum)
+        self.conv14 = GenConv(2 * cnum, 2 * cnum, 3, 1)
+        self.conv15_upsample = GenDeconv(2 * cnum, cnum)
+        self.conv16 = GenConv(cnum, cnum // 2, 3, 1)
+        self.conv17 = GenConv(cnum // 2, 3, 3, 1, activation=None)
+
+        # stage2, conv branch
+        self.xconv1 = GenConv(5, cnum, 5, 1)
+        self.xconv2_downsample = GenConv(cnum, cnum, 3, 2)
+        self.xconv3 = GenConv(cnum, 2 * cnum, 3, 1)
+        self.xconv4_downsample = GenConv(2 * cnum, 2 * cnum, 3, 2)
+        self.xconv5 = GenConv(2 * cnum, 4 * cnum, 3, 1)
+        self.xconv6 = GenConv(4 * cnum, 4 * cnum, 3, 1)
+        self.xconv7_atrous = GenConv(4 * cnum, 4 * cnum, 3, rate=2)
+        self.xconv8_atrous = GenConv(4 * cnum, 4 * cnum, 3, rate=4)
+        self.xconv9_atrous = GenConv(4 * cnum, 4 * cnum, 3, rate=8)
+        self.xconv10_atrous = GenConv(4 * cnum, 4 * cnum, 3, rate=16)
+
+        # stage2, attention branch
+        self.pmconv1 = GenConv(5, cnum, 5, 1)
+        self.pmconv2_downsample = GenConv(cnum, cnum, 3, 2)
+        self.pmconv3 = GenConv(cnum, 2 * cnum, 3, 1)
+        self.pmconv4_downsample = GenConv(2 * cnum, 4 * cnum, 3, 2)
+        self.pmconv5 = GenConv(4 * cnum, 4 * cnum, 3, 1)
+        self.pmconv6 = GenConv(4 * cnum, 4 * cnum, 3, 1, activation=F.relu)
+        self.pmconv9 = GenConv(4 * cnum, 4 * cnum, 3, 1)
+        self.pmconv10 = GenConv(4 * cnum, 4 * cnum, 3, 1)
+
+        self.allconv11 = GenConv(8 * cnum, 4 * cnum, 3, 1)
+        self.allconv12 = GenConv(4 * cnum, 4 * cnum, 3, 1)
+        self.allconv13_upsample = GenDeconv(4 * cnum, 2 * cnum)
+        self.allconv14 = GenConv(2 * cnum, 2 * cnum, 3, 1)
+        self.allconv15_upsample = GenDeconv(2 * cnum, cnum)
+        self.allconv16 = GenConv(cnum, cnum // 2, 3, 1)
+        self.allconv17 = GenConv(cnum // 2, 3, 3, 1, activation=None)
+
+    def forward(self, x, mask):
+        """
+        :param x: N x 3 x H x W incomplete image in [-1, 1]
+        :param mask: N x 1 x H x W, 1 in the hole
+        :return: stage 1 and stage 2 predictions in [-1, 1]
+        """
+        xin = x
+        ones_x = torch.ones_like(x[:, :1])
+        x = torch.cat([x, ones_x, ones_x * mask], dim=1)
+
+        # stage1
+        for name in ('conv1', 'conv2_downsample', 'conv3', 'conv4_downsample', 'conv5', 'conv6'):
+            x = getattr(self, name)(x)
+        mask_s = resize_nearest(mask, x.shape[2:])
+        for name in ('conv7_atrous', 'conv8_atrous', 'conv9_atrous', 'conv10_atrous', 'conv11', 'conv12',
+                     'conv13_upsample', 'conv14', 'conv15_upsample', 'conv16', 'conv17'):
+            x = getattr(self, name)(x)
+        x_stage1 = torch.clamp(x, -1., 1.)
+
+        # stage2, paste result as input
+        x = x_stage1 * mask + xin * (1. - mask)
+        xnow = torch.cat([x, ones_x, ones_x * mask], dim=1)
+
+        # conv branch
+        x = xnow
+        for name in ('xconv1', 'xconv2_downsample', 'xconv3', 'xconv4_downsample', 'xconv5', 'xconv6',
+                     'xconv7_atrous', 'xconv8_atrous', 'xconv9_atrous', 'xconv10_atrous'):
+            x = getattr(self, name)(x)
+        x_hallu = x
+
+        # attention branch
+        x = xnow
+        for name in ('pmconv1', 'pmconv2_downsample', 'pmconv3', 'pmconv4_downsample', 'pmconv5', 'pmconv6'):
+            x = getattr(self, name)(x)
+        x = contextual_attention(x, x, mask_s, 3, 1, rate=2)
+        pm = self.pmconv10(self.pmconv9(x))
+
+        x = torch.cat([x_hallu, pm], dim=1)
+        for name in ('allconv11', 'allconv12', 'allconv13_upsample', 'allconv14', 'allconv15_upsample', 'allconv16',
+                     'allconv17'):
+            x = getattr(self, name)(x)
+        x_stage2 = torch.clamp(x, -1., 1.)
+        return x_stage1, x_stage2
+
+    def complete(self, images, masks):
+        """
+        InpaintCAModel.build_server_graph.
+        :param images: N x 3 x H x W BGR images in 0 - 255
+        :param masks: N x 1 x H x W, 1 in the hole
+        :return: N x 3 x H x W BGR completed images in [-1, 1]
+        """
+        batch_incomplete = (images / 127.5 - 1.) * (1. - masks)
+        _, x2 = self(batch_incomplete, masks)
+        return x2 * masks + batch_incomplete * (1. - masks)
+
+    def load_tf_variables(self, variables, scope='inpaint_net'):
+        """Copies the kernels and biases of a tensorflow checkpoint (see read_tf_checkpoint)."""
+        state = {}
+        for name, module in self.named_children():
+            # gen_deconv wraps its convolution in a variable scope of the same name
+            tf_name = '{0}/{1}/{1}_conv'.format(scope, name) if isinstance(module, GenDeconv) else \
+                '{}/{}'.format(scope, name)
+            state[name + '.conv.weight'] = torch.from_numpy(variables[tf_name + '/kernel']).permute(3, 2, 0, 1)
+            state[name + '.conv.bias'] = torch.from_numpy(variables[tf_name + '/bias'])
+        self.load_state_dict(state)
+        return self
+
+
+def convert_checkpoint(checkpoint_dir, path=None):
+    """
+    Converts the generator of a tensorflow checkpoint into a PyTorch state dict.
+    :param path: output file, None = inpaint_net_{checkpoint id}.pth next to the checkpoint
+    :return: path of the state dict
+    """
+    path = converted_path(checkpoint_dir) if path is None else path
+    net = InpaintCANet().load_tf_variables(read_tf_checkpoint(checkpoint_dir))
+    torch.save(net.state_dict(), path)
+    return path
+
+
+def converted_path(checkpoint_dir):
+    """Cached PyTorch state dict of the latest checkpoint, a new checkpoint in the directory gets a new file."""
+    return os.path.join(checkpoint_dir, 'inpaint_net_{}.pth'.format(checkpoint_id(checkpoint_dir)))
+
+
+def load_inpaint_net(checkpoint_dir):
+    """InpaintCANet of a checkpoint directory, converted on first use and cached next to it, see converted_path."""
+    path = converted_path(checkpoint_dir)
+    if not os.path.exists(path):
+        try:
+            convert_checkpoint(checkpoint_dir, path)
+        except (IOError, OSError):
+            # Read-only checkpoint directory
+            return InpaintCANet().load_tf_variables(read_tf_checkpoint(checkpoint_dir)).eval()
+    net = InpaintCANet()
+    net.load_state_dict(torch.load(path, map_location='cpu'))
+    return net.eval()
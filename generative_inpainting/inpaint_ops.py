@@ -214,7 +214,8 @@ def spatial_discounting_mask(config):
 
 
 def contextual_attention(f, b, mask=None, ksize=3, stride=1, rate=1,
-                         fuse_k=3, softmax_scale=10., training=True, fuse=True):
+                         fuse_k=3, softmax_scale=10., training=True, fuse=True,
+                         return_flow=True):
     """ Contextual attention layer implementation.
 
     Contextual attention is first introduced in publication:
@@ -229,6 +230,8 @@ def contextual_attention(f, b, mask=None, ksize=3, stride=1, rate=1,
         rate: Dilation for matching.
         softmax_scale: Scaled softmax for attention.
         training: Indicating if current graph is training or inference.
+        return_flow: Compute the offset flow visualization, if False None
+            is returned for it.
 
     Returns:
         tf.Tensor: output
@@ -305,17 +308,20 @@ def contextual_attention(f, b, mask=None, ksize=3, stride=1, rate=1,
         yi = tf.nn.softmax(yi*scale, 3)
         yi *=  mm  # mask
 
-        offset = tf.argmax(yi, axis=3, output_type=tf.int32)
-        offset = tf.stack([offset // fs[2], offset % fs[2]], axis=-1)
+        if return_flow:
+            offset = tf.argmax(yi, axis=3, output_type=tf.int32)
+            offset = tf.stack([offset // fs[2], offset % fs[2]], axis=-1)
+            offsets.append(offset)
         # deconv for patch pasting
         # 3.1 paste center
         wi_center = raw_wi[0]
         yi = tf.nn.conv2d_transpose(yi, wi_center, tf.concat([[1], raw_fs[1:]], axis=0),
                                     strides=[1,rate,rate,1]) / 4.
         y.append(yi)
-        offsets.append(offset)
     y = tf.concat(y, axis=0)
     y.set_shape(raw_int_fs)
+    if not return_flow:
+        return y, None
     offsets = tf.concat(offsets, axis=0)
     offsets.set_shape(int_bs[:3] + [2])
     # case1: visualize optical flow: minus current position
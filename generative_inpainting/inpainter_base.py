@@ -0,0 +1,231 @@
+import time
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+
+class InpainterBase(object):
+    '''
+    Conversions between pytorch images and the inputs of the CA-inpainting network, crop (ROI) inpainting and
+    caching, shared by the tensorflow (CAInpainter) and pytorch (CAInpainter2) implementations of the network.
+    '''
+    # The network downsamples 4x and contextual attention another 2x, crops are multiples of this
+    roi_multiple = 8
+
+    def __init__(self, batch_size, roi_context=0, cache=None, cache_tag=''):
+        '''
+        :param batch_size: largest number of images per network call, larger inputs are split
+        :param roi_context: if > 0, generate_background only inpaints a crop around each hole with this many
+                            pixels (at 256 x 256) of context on each side, see generate_background_roi
+        :param cache: optional InpaintCache looked up before running the network
+        :param cache_tag: implementation and checkpoint of the network, part of every cache key so that runs
+                          sharing a cache directory never read each other's backgrounds
+        '''
+        self.batch_size = batch_size
+        self.roi_context = roi_context
+        self.cache = cache
+        self.cache_tag = cache_tag
+
+        self.pth_mean = np.ones((1, 3, 1, 1), dtype='float32')
+        self.pth_mean[0, :, 0, 0] = np.array([0.485, 0.456, 0.406])
+        self.pth_std = np.ones((1, 3, 1, 1), dtype='float32')
+        self.pth_std[0, :, 0, 0] = np.array([0.229, 0.224, 0.225])
+        self.upsample = torch.nn.Upsample(size=(256, 256), mode='bilinear')
+        self.downsample = torch.nn.Upsample(size=(224, 224), mode='bilinear')
+
+    @staticmethod
+    def memory_per_sample():
+        '''
+        Rough working memory (in bytes) of one sample in generate_background.
+        '''
+        # float64 numpy buffers: 256 x 256 image and mask, and the 256 x 512 network input
+        numpy_bytes = 8 * 3 * (256 * 256 * 2 + 256 * 512)
+        # widest feature maps are 32 x 256 x 256, about three of them are alive at a time
+        conv_bytes = 4 * 3 * 32 * 256 * 256
+        # contextual attention scores are (32 x 32) x (32 x 32) and get copied by the fuse step
+        attention_bytes = 4 * 4 * (32 * 32) ** 2
+        return numpy_bytes + conv_bytes + attention_bytes
+
+    def impute_missing_imgs(self, pytorch_image, pytorch_mask):
+        '''
+        :param pytorch_image: 1 x 3 x 224 x 224
+        :param pytorch_mask: 1 x 3 x 224 x 224. Mask
+        :return:
+        '''
+        pth_img = self.generate_background(pytorch_image, pytorch_mask)
+
+        return pytorch_image * pytorch_mask + pth_img * (1. - pytorch_mask)
+
+    def generate_background(self, pytorch_image, pytorch_mask, batch_process=False):
+        '''
+        Use to generate whole blurry images with pytorch normalization.
+        '''
+        image, mask = self.to_tf_inputs(pytorch_image, pytorch_mask, batch_process)
+
+        # t1 = time.time()
+        if self.cache is None:
+            tf_images = self.inpaint(image, mask)
+        else:
+            tf_images = self.cached_inpaint(image, mask, batch_process)
+        # print(time.time() - t1)
+        # print('#'*25)
+
+        return self.to_pytorch(tf_images, pytorch_image), mask
+
+    def generate_background_roi(self, pytorch_image, pytorch_mask, batch_process=False, context=None):
+        '''
+        Same as generate_background, but only a square crop around the hole of every mask is inpainted.
+        Crops are sized for the largest hole of the batch plus context, rounded up to a multiple of
+        roi_multiple, and run in a single network call. Outside the crops the original image is returned.
+        '''
+        context = self.roi_context if context is None else context
+        image, mask = self.to_tf_inputs(pytorch_image, pytorch_mask, batch_process)
+        return self.to_pytorch(self._inpaint_roi(image, mask, context), pytorch_image), mask
+
+    def inpaint(self, image, mask):
+        '''
+        Runs the network on any number of network inputs (see to_tf_inputs).
+        :return: N x 256 x 256 x 3 RGB uint8 images
+        '''
+        if self.roi_context > 0:
+            return self._inpaint_roi(image, mask, self.roi_context)
+        return self._inpaint_full(image, mask)
+
+    def cached_inpaint(self, image, mask, batch_process=False):
+        '''
+        inpaint with a lookup of every (image, mask) pair in self.cache, only the misses are run.
+        '''
+        image_keys = [self.cache.image_key(image[0])] * len(image) if batch_process else \
+            [self.cache.image_key(img) for img in image]
+        keys = [self.cache.key(image_key, m, self.roi_context, self.cache_tag)
+                for image_key, m in zip(image_keys, mask)]
+
+        tf_images = [self.cache.get(key) for key in keys]
+        missing = [k for k, tf_image in enumerate(tf_images) if tf_image is None]
+        if missing:
+            inpainted = self.inpaint(image[missing], mask[missing])
+            for k, tf_image in zip(missing, inpainted):
+                self.cache.put(keys[k], tf_image)
+                tf_images[k] = tf_image
+        return np.stack(tf_images)
+
+    def _inpaint_full(self, image, mask):
+        input_image = np.concatenate([image, mask], axis=2)
+
+        # DEBUG
+        # import cv2
+        # cv2.imwrite('./test_input.jpg', input_image[0])
+
+        return self.run_network(input_image)
+
+    def _inpaint_roi(self, image, mask, context):
+        num, size = mask.shape[0], mask.shape[1]
+
+        # Bounding box of every hole
+        hole = mask[:, :, :, 0] > 127.5
+        rows, cols = hole.any(axis=2), hole.any(axis=1)
+        y0, y1 = rows.argmax(axis=1), size - rows[:, ::-1].argmax(axis=1)
+        x0, x1 = cols.argmax(axis=1), size - cols[:, ::-1].argmax(axis=1)
+        empty = ~rows.any(axis=1)
+        y0[empty], y1[empty], x0[empty], x1[empty] = size // 2, size // 2, size // 2, size // 2
+        side = int(max((y1 - y0).max(), (x1 - x0).max())) + 2 * context
+        side = min(int(np.ceil(side / float(self.roi_multiple))) * self.roi_multiple, size)
+
+        # Square crops centred on the holes, shifted inside the image
+        top = np.clip((y0 + y1 - side) // 2, 0, size - side)
+        left = np.clip((x0 + x1 - side) // 2, 0, size - side)
+        crops = np.zeros((num, side, 2 * side, 3))
+        for k in range(num):
+            crops[k] = np.concatenate([image[k, top[k]:top[k] + side, left[k]:left[k] + side],
+                                       mask[k, top[k]:top[k] + side, left[k]:left[k] + side]], axis=1)
+
+        tf_crops = self.run_network(crops)
+
+        # Paste the crops back, network outputs are RGB uint8
+        tf_images = np.clip(image[:, :, :, ::-1], 0, 255).astype(np.uint8)
+        for k in range(num):
+            tf_images[k, top[k]:top[k] + side, left[k]:left[k] + side] = tf_crops[k]
+        return tf_images
+
+    def run_network(self, input_image):
+        '''
+        :param input_image: N x side x 2 side x 3 network inputs, BGR image (0 - 255) next to its mask (255 in
+                            the hole), any N and side a multiple of roi_multiple
+        :return: N x side x side x 3 RGB uint8 completed images
+        '''
+        raise NotImplementedError
+
+    def roi_quality(self, pytorch_image, pytorch_mask, batch_process=False, context=None):
+        '''
+        Compares crop inpainting with full-frame inpainting on the same masks, bypassing the cache.
+        :return: mean absolute difference inside the holes (0 - 255 scale), full-frame and crop seconds
+        '''
+        context = self.roi_context if context is None else context
+        image, mask = self.to_tf_inputs(pytorch_image, pytorch_mask, batch_process)
+        t0 = time.time()
+        full = self._inpaint_full(image, mask)
+        t1 = time.time()
+        roi = self._inpaint_roi(image, mask, context)
+        t2 = time.time()
+
+        hole = mask > 127.5
+        diff = np.abs(full.astype(float) - roi.astype(float))
+        return diff[hole].mean(), t1 - t0, t2 - t1
+
+    def to_tf_inputs(self, pytorch_image, pytorch_mask, batch_process=False):
+        '''
+        Converts pytorch inputs to the 256 x 256 BGR images (0 - 255) and masks (255 in the hole) of the network.
+        '''
+        mask = pytorch_mask.expand(pytorch_mask.shape[0], 3, 224, 224)
+        mask = self.upsample(Variable(mask)).data  # .round()
+        mask = mask.cpu().numpy()
+        # Every mask of a batch is thresholded on its own range
+        thresh = np.maximum(0.5, 0.5 * (mask.max(axis=(1, 2, 3)) + mask.min(axis=(1, 2, 3))))
+        mask = (mask < thresh[:, None, None, None]).astype(float)
+
+        # Make it into tensorflow input ordering, then resizing then normalization
+        # Do 3 things:
+        # - Move from NCHW to NHWC, and from RGB to BGR input
+        # - Normalize to 0 - 255 with integer round up
+        # - Resize the image size to be 256 x 256
+        mask = np.moveaxis(mask, 1, -1)*255
+        # mask = (1. - mask) * 255
+
+        image = self.upsample(Variable(pytorch_image)).data.cpu().numpy()
+        image = np.round((image * self.pth_std + self.pth_mean) * 255)
+        image = np.moveaxis(image, 1, -1)
+        image = image[:, :, :, ::-1]
+
+        if batch_process:
+            image = np.stack((image[0, :], )*mask.shape[0], axis=0)
+
+        return image, mask
+
+    def to_pytorch(self, tf_images, pytorch_image):
+        '''
+        Converts RGB network outputs (0 - 255, 256 x 256) back to 224 x 224 pytorch normalized images.
+        '''
+        # it's RGB back. So just change back to pytorch normalization
+        pth_img = np.moveaxis(tf_images, 3, 1)
+        pth_img = ((pth_img / 255.) - self.pth_mean) / self.pth_std
+
+        pth_img = pytorch_image.new(pth_img)
+        pth_img = self.downsample(Variable(pth_img)).data
+
+        return pth_img
+
+    def time_impute_missing_imgs(self, pytorch_image, pytorch_mask):
+        start_time = time.time()
+        result = self.impute_missing_imgs(pytorch_image, pytorch_mask)
+        print('Total time:', time.time() - start_time)
+        return result
+
+    def reset(self):
+        pass
+
+    def eval(self):
+        pass
+
+    def cuda(self):
+        self.upsample.cuda()
+        self.downsample.cuda()
@@ -132,7 +132,7 @@ class LimeImageExplainer(object):
                          segmentation_fn=None,
                          distance_metric='cosine',
                          model_regressor=None,
-                         random_seed=None, fill_type='LIME', num_super_pixel=50, sav_path='', target_category=0):
+                         random_seed=None, fill_type='LIME', num_super_pixel=50, writer=None, target_category=0):
         """Generates explanations for a prediction.
 
         First, we generate neighborhood data by randomly perturbing features
@@ -163,6 +163,8 @@ class LimeImageExplainer(object):
             random_seed: integer used as random seed for the segmentation
                 algorithm. If None, a random integer, between 0 and 1000,
                 will be generated using the internal random number generator.
+            writer: IntermediateWriter for the perturbed samples, None to
+                skip them.
 
         Returns:
             An Explanation object (see explanation.py) with the corresponding
@@ -193,7 +195,7 @@ class LimeImageExplainer(object):
 
         data, labels = self.data_labels(image, pytorch_img, inpaint_model, fudged_image, segments,
                                         classifier_fn, num_samples, label_map=l_map,
-                                        batch_size=batch_size, f_type=fill_type, num_super_pixel=num_super_pixel, save_path=sav_path, gt_category=target_category)
+                                        batch_size=batch_size, f_type=fill_type, num_super_pixel=num_super_pixel, writer=writer, gt_category=target_category)
         # import ipdb
         # ipdb.set_trace()
         distances = sklearn.metrics.pairwise_distances(
@@ -233,7 +235,7 @@ class LimeImageExplainer(object):
                     segments,
                     classifier_fn,
                     num_samples, label_map,
-                    batch_size=10, f_type='LIME', num_super_pixel=50, save_path='', gt_category=0):
+                    batch_size=10, f_type='LIME', num_super_pixel=50, writer=None, gt_category=0):
         """Generates images and predictions in the neighborhood of this image.
 
         Args:
@@ -245,6 +247,8 @@ class LimeImageExplainer(object):
                 matrix of prediction probabilities
             num_samples: size of the neighborhood to learn the linear model
             batch_size: classifier_fn will be called on batches of this size.
+            writer: IntermediateWriter for the perturbed samples, labelled
+                with the batch predictions.
 
         Returns:
             A tuple (data, labels), where:
@@ -259,8 +263,7 @@ class LimeImageExplainer(object):
         data[0, :] = 1
         imgs = []
         temp_mask = torch.tensor([]) 
-        ind = 0
-        for row in data:
+        for k, row in enumerate(data):
             temp = copy.deepcopy(image)
             zeros = np.where(row == 0)[0]
             mask = np.zeros(segments.shape).astype(bool)
@@ -276,45 +279,30 @@ class LimeImageExplainer(object):
                 else:
                     temp_mask = torch.cat((temp_mask, (1 - torch.from_numpy(mask).unsqueeze(0).float()).expand(3, mask.shape[0], mask.shape[1]).unsqueeze(0)), dim=0)
 
-            if f_type == 'LIME':
-                # Save intermediate steps
-                outputs = classifier_fn(np.array([temp]))
-                amax, aind = outputs.max(dim=1)
-                gt_val = outputs.data[:, gt_category]
-                cv2.imwrite(
-                    os.path.join(save_path, 'intermediate_{:04d}_{}_{:.3f}_{}_{:.3f}.jpg'
-                                 .format(ind, label_map[aind.item()].split(',')[0].split(' ')[0].split('-')[0],
-                                         amax.item(), label_map[gt_category].split(',')[0].split(' ')[0].split('-')[0],
-                                         gt_val.item())), cv2.cvtColor(np.array([temp])[0, :], cv2.COLOR_BGR2RGB))
-                ind += 1           
-            
             imgs.append(temp)
-            if len(imgs) == batch_size:
+            # The tail batch goes through the same path, the inpainter takes any batch size
+            if len(imgs) == batch_size or k == len(data) - 1:
                 if f_type == 'LIMEG':
                     inpaint_img, _ = inpaint_model.generate_background(pytorch_img, temp_mask, batch_process=True)
                     inpaint_img = pytorch_img.cpu() * temp_mask + inpaint_img.cpu() * (1 - temp_mask)
                     inpaint_img = np.uint8(255 * self.unnormalize(np.moveaxis(inpaint_img.cpu().detach().numpy().transpose(), 0, 1)))
                     inpaint_img = np.rollaxis(inpaint_img, -1)
                     preds = classifier_fn(inpaint_img)
-                    for ii in range(batch_size):
-                       temp_output = classifier_fn(np.expand_dims(inpaint_img[ii, :], axis=0))
-                       # Save intermediate steps
-                       amax, aind = temp_output.max(dim=1)
-                       gt_val = temp_output.data[:, gt_category]
-                       cv2.imwrite(os.path.join(save_path, 'intermediate_{:04d}_{}_{:.3f}_{}_{:.3f}.jpg'
-                           .format(ind*batch_size + ii, label_map[aind.item()].split(',')[0].split(' ')[0].split('-')[0], 
-                               amax.item(), label_map[gt_category].split(',')[0].split(' ')[0].split('-')[0], 
-                               gt_val.item())), cv2.cvtColor(inpaint_img[ii, :], cv2.COLOR_BGR2RGB))
-
-                    ind += 1
+                    # Save intermediate steps, labelled with the batch predictions
+                    self.save_intermediate(writer, len(labels), inpaint_img, preds, gt_category)
                     labels.extend(preds.data.cpu().numpy())
                     temp_mask = torch.tensor([])
                     imgs=[]
                 else:
                     preds = classifier_fn(np.array(imgs))
+                    self.save_intermediate(writer, len(labels), imgs, preds, gt_category)
                     labels.extend(preds.data.cpu().numpy())
                     imgs = []
-        if len(imgs) > 0:
-            preds = classifier_fn(np.array(imgs))
-            labels.extend(preds.data.cpu().numpy())
         return data, np.array(labels)
+
+    @staticmethod
+    def save_intermediate(writer, start, imgs, preds, gt_category):
+        if writer is None:
+            return
+        for j in writer.select(start, len(imgs)):
+            writer.submit(start + j, imgs[j], preds.data[j], gt_category)